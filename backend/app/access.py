@@ -0,0 +1,64 @@
+import os
+
+from sqlalchemy import exists, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import defer
+
+from .cache import TTLCache
+from . import metrics
+from .models import Canvas, Invitation
+
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "10000"))
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL", "30"))
+
+
+class CanvasAccess:
+    def __init__(self, maxsize: int = ACCESS_CACHE_SIZE, ttl: float = ACCESS_CACHE_TTL):
+        # (canvas_id, user_id) -> may the user open the canvas
+        self.cache = TTLCache(maxsize, ttl)
+
+    def _allowed(self, user):
+        invited = exists().where(
+            Invitation.canvas_id == Canvas.id,
+            # both sides are stored lowercased, so ix_invitations_canvas_email applies
+            Invitation.invitee_email == user.email.lower(),
+        )
+        return or_(Canvas.owner_id == user.id, invited).label("allowed")
+
+    async def authorize(
+        self,
+        db: AsyncSession,
+        canvas_id: int,
+        user,
+        load: bool = True,
+        with_content: bool = True,
+    ) -> tuple[bool | None, Canvas | None]:
+        # allowed is None when the canvas doesn't exist; the canvas row comes
+        # back from the same query unless a cached answer is good enough
+        key = (canvas_id, user.id)
+        if not load:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached, None
+
+        query = select(Canvas, self._allowed(user)).where(Canvas.id == canvas_id)
+        if not (load and with_content):
+            query = query.options(defer(Canvas.content))
+        row = (await db.execute(query)).first()
+        if row is None:
+            return None, None
+        canvas, allowed = row
+        allowed = bool(allowed)
+        self.cache.set(key, allowed)
+        return allowed, canvas
+
+    def invalidate_canvas(self, canvas_id: int):
+        self.cache.invalidate_where(lambda key: key[0] == canvas_id)
+
+    def invalidate_user(self, user_id: int):
+        self.cache.invalidate_where(lambda key: key[1] == user_id)
+
+
+access = CanvasAccess()
+metrics.caches["access"] = access.cache
@@ -1,25 +1,137 @@
+import asyncio
 import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from fastapi.security import OAuth2PasswordBearer
+from .cache import TTLCache
+from . import metrics
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+# bcrypt runs in a "thread" or "process" pool so it never blocks the event loop
+HASH_POOL_KIND = os.getenv("HASH_POOL_KIND", "thread")
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
 
 if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY environment variable is required")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
+# what authenticated routes get instead of a session-bound User row
+@dataclass(frozen=True)
+class Principal:
+    id: int
+    email: str
+
+# (token subject, token) -> Principal
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+metrics.caches["user"] = user_cache
+
+def invalidate_user(email: str):
+    email = email.lower()
+    user_cache.invalidate_where(lambda key: key[0].lower() == email)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+class HashPoolSaturated(Exception):
+    pass
+
+class HashPool:
+    def __init__(self, kind: str = HASH_POOL_KIND, size: int = HASH_POOL_SIZE, max_pending: int = HASH_MAX_PENDING):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unsupported HASH_POOL_KIND: {kind!r}")
+        self.kind = kind
+        self.size = size
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            pool = ThreadPoolExecutor if self.kind == "thread" else ProcessPoolExecutor
+            self._executor = pool(max_workers=self.size)
+        return self._executor
+
+    async def run(self, fn, *args):
+        # admission control: shed load instead of queueing without bound
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HashPoolSaturated()
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.pending -= 1
+            self.completed += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.size,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "queued": max(0, self.pending - self.size),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "latency_avg_ms": round(1000 * self.total_seconds / self.completed, 3) if self.completed else 0.0,
+            "latency_max_ms": round(1000 * self.max_seconds, 3),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+hash_pool = HashPool()
+
+metrics.registry.gauge(
+    "hash_pool_pending", "Password hashes running or waiting for a worker", collect=lambda: {(): hash_pool.pending}
+)
+metrics.registry.gauge(
+    "hash_pool_queued", "Password hashes waiting for a worker",
+    collect=lambda: {(): max(0, hash_pool.pending - hash_pool.size)},
+)
+metrics.registry.gauge("hash_pool_workers", "Password hashing workers", collect=lambda: {(): hash_pool.size})
+metrics.registry.counter(
+    "hash_pool_completed_total", "Password hashes finished", collect=lambda: {(): hash_pool.completed}
+)
+metrics.registry.counter(
+    "hash_pool_rejected_total", "Password hashes refused because the queue was full",
+    collect=lambda: {(): hash_pool.rejected},
+)
+metrics.registry.counter(
+    "hash_pool_seconds_total", "Time spent on password hashes, queueing included",
+    collect=lambda: {(): hash_pool.total_seconds},
+)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await hash_pool.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await hash_pool.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: timedelta = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -0,0 +1,243 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+from sqlalchemy.future import select
+
+from .database import async_session
+from .models import Blob
+
+BLOB_DIR = os.getenv("BLOB_DIR", "data/blobs")
+BLOB_URL_PREFIX = os.getenv("BLOB_URL_PREFIX", "/api/blobs").rstrip("/")
+BLOB_MIN_BYTES = int(os.getenv("BLOB_MIN_BYTES", "1024"))
+BLOB_GC_INTERVAL = float(os.getenv("BLOB_GC_INTERVAL", "3600"))
+BLOB_GC_GRACE = float(os.getenv("BLOB_GC_GRACE", "3600"))
+
+# Blobs are served from the app's own origin, where an HTML or SVG file could
+# run script with the user's session, so only these types are ever extracted
+# or accepted; other data URLs stay inline in the canvas.
+BLOB_MIME_TYPES = frozenset({"image/png", "image/jpeg", "image/gif", "image/webp"})
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?((?:;[^;,]*)*?);base64,", re.IGNORECASE)
+
+def safe_mime(mime: str | None) -> bool:
+    return bool(mime) and (mime in BLOB_MIME_TYPES or (mime.startswith("audio/") and "+" not in mime))
+
+
+# leading bytes of each accepted format; audio subtypes vary too much between
+# browsers to tie one to its signature, so any known audio container will do
+IMAGE_SIGNATURES = {
+    "image/png": (b"\x89PNG\r\n\x1a\n",),
+    "image/jpeg": (b"\xff\xd8\xff",),
+    "image/gif": (b"GIF87a", b"GIF89a"),
+}
+AUDIO_SIGNATURES = (b"ID3", b"OggS", b"fLaC", b"\x1a\x45\xdf\xa3", b"\xff\xf1", b"\xff\xf9", b"\xff\xfb", b"\xff\xf3", b"\xff\xf2")
+
+
+def content_matches(mime: str, head: bytes) -> bool:
+    # whether a file's first 16 bytes look like the type it claims to be
+    if mime == "image/webp":
+        return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+    if mime in IMAGE_SIGNATURES:
+        return head.startswith(IMAGE_SIGNATURES[mime])
+    if safe_mime(mime):
+        return (
+            head.startswith(AUDIO_SIGNATURES)
+            or (head[:4] == b"RIFF" and head[8:12] == b"WAVE")
+            or head[4:8] == b"ftyp"
+        )
+    return False
+
+
+def blob_url(digest: str) -> str:
+    return f"{BLOB_URL_PREFIX}/{digest}"
+
+
+def blob_digest(value) -> str | None:
+    if not isinstance(value, str) or not value.startswith(BLOB_URL_PREFIX + "/"):
+        return None
+    digest = value[len(BLOB_URL_PREFIX) + 1:]
+    return digest if DIGEST_RE.match(digest) else None
+
+
+def _object_values(content: dict):
+    yield content.get("image")
+    for obj in content.get("objects") or []:
+        if isinstance(obj, dict):
+            yield from obj.values()
+
+
+def blob_refs(content: dict | None) -> set[str]:
+    if not content:
+        return set()
+    refs = set()
+    for value in _object_values(content):
+        digest = blob_digest(value)
+        if digest:
+            refs.add(digest)
+    return refs
+
+
+def parse_data_url(value) -> tuple[str, bytes] | None:
+    if not isinstance(value, str) or len(value) < BLOB_MIN_BYTES:
+        return None
+    match = DATA_URL_RE.match(value)
+    if not match:
+        return None
+    try:
+        data = base64.b64decode(value[match.end():], validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return (match.group(1) or "application/octet-stream").lower(), data
+
+
+class BlobStore:
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def write(self, digest: str, data: bytes):
+        path = self.path(digest)
+        if os.path.exists(path):
+            # fresh again, so the file sweep leaves it alone until it's registered
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def remove(self, digest: str):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _externalize(self, content: dict) -> tuple[dict, dict[str, tuple[str, int]]]:
+        created: dict[str, tuple[str, int]] = {}
+
+        def convert(value):
+            parsed = parse_data_url(value)
+            if parsed is None:
+                return value
+            mime, data = parsed
+            if not safe_mime(mime):
+                return value
+            digest = hashlib.sha256(data).hexdigest()
+            self.write(digest, data)
+            created[digest] = (mime, len(data))
+            return blob_url(digest)
+
+        stored = dict(content)
+        if "image" in stored:
+            stored["image"] = convert(stored["image"])
+        objects = []
+        for obj in content.get("objects") or []:
+            if isinstance(obj, dict):
+                converted = {key: convert(value) for key, value in obj.items()}
+                if any(converted[key] is not obj[key] for key in obj):
+                    obj = converted
+            objects.append(obj)
+        if "objects" in stored:
+            stored["objects"] = objects
+        return stored, created
+
+    async def externalize(self, content: dict) -> tuple[dict, dict[str, tuple[str, int]]]:
+        # base64 decoding, hashing and disk writes stay off the event loop
+        return await asyncio.to_thread(self._externalize, content)
+
+    async def collect_garbage(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=BLOB_GC_GRACE)
+        async with async_session() as db:
+            result = await db.execute(
+                select(Blob.hash)
+                .where(Blob.refcount <= 0)
+                .where(Blob.updated_at < cutoff)
+            )
+            removed = []
+            for digest in result.scalars().all():
+                # re-check: the blob may have been referenced or uploaded again
+                deleted = await db.execute(
+                    delete(Blob)
+                    .where(Blob.hash == digest)
+                    .where(Blob.refcount <= 0)
+                    .where(Blob.updated_at < cutoff)
+                )
+                if deleted.rowcount:
+                    removed.append(digest)
+            await db.commit()
+        for digest in removed:
+            await asyncio.to_thread(self.remove, digest)
+        return len(removed)
+
+    def _old_files(self, cutoff: float) -> list[str]:
+        # digests of files not written since cutoff; stale temp files go too
+        digests = []
+        try:
+            shards = os.listdir(self.root)
+        except FileNotFoundError:
+            return digests
+        for shard in shards:
+            try:
+                entries = list(os.scandir(os.path.join(self.root, shard)))
+            except (NotADirectoryError, FileNotFoundError):
+                continue
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                    if entry.name.startswith(".tmp-"):
+                        os.unlink(entry.path)
+                    elif DIGEST_RE.match(entry.name):
+                        digests.append(entry.name)
+                except FileNotFoundError:
+                    pass
+        return digests
+
+    def _remove_if_old(self, digest: str, cutoff: float) -> bool:
+        try:
+            if os.path.getmtime(self.path(digest)) >= cutoff:
+                return False
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def sweep_files(self) -> int:
+        # The row GC above runs on one worker, which can only unlink files on
+        # its own disk. This runs on every worker and removes files here that
+        # no row refers to, once they are older than the grace period.
+        cutoff = time.time() - BLOB_GC_GRACE
+        digests = await asyncio.to_thread(self._old_files, cutoff)
+        removed = 0
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            async with async_session() as db:
+                result = await db.execute(select(Blob.hash).where(Blob.hash.in_(batch)))
+                known = set(result.scalars().all())
+            for digest in batch:
+                if digest not in known and await asyncio.to_thread(self._remove_if_old, digest, cutoff):
+                    removed += 1
+        return removed
+
+
+blob_store = BlobStore()
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import zlib
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+# bodies at least this big are compressed on a worker thread
+COMPRESSION_THREAD_MIN = int(os.getenv("COMPRESSION_THREAD_MIN", str(256 * 1024)))
+
+# already compressed or streamed media gains nothing from another pass
+INCOMPRESSIBLE_TYPES = ("image/", "audio/", "video/", "application/zip", "application/gzip", "application/zstd")
+
+try:
+    from compression import zstd as _stdlib_zstd  # Python 3.14+
+except ImportError:
+    _stdlib_zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class _GzipCompressor:
+    def __init__(self):
+        self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+
+class _ZstdCompressor:
+    def __init__(self):
+        if _stdlib_zstd is not None:
+            self._obj = _stdlib_zstd.ZstdCompressor(level=ZSTD_LEVEL)
+        else:
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self):
+        self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.process(data)
+
+    def flush(self) -> bytes:
+        return self._obj.finish()
+
+
+# in server preference order
+ENCODINGS = {}
+if _stdlib_zstd is not None or zstandard is not None:
+    ENCODINGS["zstd"] = _ZstdCompressor
+if brotli is not None:
+    ENCODINGS["br"] = _BrotliCompressor
+ENCODINGS["gzip"] = _GzipCompressor
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {k.lower(): v for k, v in scope.get("headers", [])}
+        encoding = choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressingResponder(self.app, encoding, self.minimum_size)(scope, receive, send)
+
+
+class _CompressingResponder:
+    def __init__(self, app, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send = None
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_wrapper)
+
+    def _should_skip(self, message) -> bool:
+        if message["status"] < 200 or message["status"] in (204, 206, 304):
+            return True
+        headers = {k.lower(): v for k, v in message.get("headers", [])}
+        if b"content-encoding" in headers or b"content-range" in headers:
+            return True
+        content_type = headers.get(b"content-type", b"").decode("latin-1").lower()
+        return content_type.startswith(INCOMPRESSIBLE_TYPES)
+
+    async def _compress(self, data: bytes, final: bool) -> bytes:
+        def run():
+            chunk = self.compressor.compress(data)
+            return chunk + self.compressor.flush() if final else chunk
+
+        if len(data) >= COMPRESSION_THREAD_MIN:
+            return await asyncio.to_thread(run)
+        return run()
+
+    async def send_wrapper(self, message):
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        if message["type"] == "http.response.start":
+            if self._should_skip(message):
+                self.passthrough = True
+                await self.send(message)
+            else:
+                self.start_message = message
+            return
+
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressor is None:
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            self.compressor = ENCODINGS[self.encoding]()
+            headers = [
+                (k, v) for k, v in self.start_message.get("headers", [])
+                if k.lower() not in (b"content-length", b"vary")
+            ]
+            vary = [v for k, v in self.start_message.get("headers", []) if k.lower() == b"vary"]
+            vary_values = [v.decode("latin-1") for v in vary] + ["Accept-Encoding"]
+            headers.append((b"content-encoding", self.encoding.encode()))
+            headers.append((b"vary", ", ".join(vary_values).encode("latin-1")))
+            if not more_body:
+                compressed = await self._compress(body, final=True)
+                headers.append((b"content-length", str(len(compressed)).encode()))
+                await self.send({**self.start_message, "headers": headers})
+                await self.send({"type": "http.response.body", "body": compressed})
+                return
+            await self.send({**self.start_message, "headers": headers})
+
+        chunk = await self._compress(body, final=not more_body)
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": more_body})
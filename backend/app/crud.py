@@ -1,20 +1,21 @@
 import secrets
+from sqlalchemy import delete, update, and_, or_, distinct, func, union_all
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from .models import User, Canvas, Invitation
-from .auth import get_password_hash
+from .models import User, Canvas, Invitation, Blob
+from .blobs import blob_refs
+from .access import access
 from typing import Optional
 from datetime import datetime, timedelta
-from .auth import get_password_hash, verify_password
+from .auth import get_password_hash_async, verify_password_async, invalidate_user
 
 async def get_user_by_email(db: AsyncSession, email: str):
-    result = await db.execute(select(User).where(User.email == email))
+    result = await db.execute(select(User).where(User.email == email.lower()))
     return result.scalars().first()
 
 async def create_user(db: AsyncSession, email: str, password: str):
-    user = User(email=email, hashed_password=get_password_hash(password))
+    user = User(email=email.lower(), hashed_password=await get_password_hash_async(password))
     db.add(user)
     try:
         await db.commit()
@@ -28,6 +29,54 @@ async def get_canvases_by_owner(db: AsyncSession, owner_id: int):
     result = await db.execute(select(Canvas).where(Canvas.owner_id == owner_id))
     return result.scalars().all()
 
+DASHBOARD_FIELDS = ("id", "name", "owner_id", "role", "created_at", "updated_at", "invites", "members")
+
+async def get_dashboard(db: AsyncSession, user, limit: int, after: Optional[tuple] = None, fields=DASHBOARD_FIELDS):
+    # Owned and shared canvases, newest first, one page at a time. Owned ones
+    # are read off ix_canvases_owner_updated in (updated_at, id) order and
+    # stop after a page; shared ones are found through the user's invitations
+    # (ix_invitations_invitee_email) and sorted, so they cost as many as the
+    # user has been invited to. Counts are only computed for the rows that
+    # make the page.
+    def page(query):
+        if after is not None:
+            updated_at, canvas_id = after
+            query = query.where(or_(
+                Canvas.updated_at < updated_at,
+                and_(Canvas.updated_at == updated_at, Canvas.id < canvas_id),
+            ))
+        return select(query.order_by(Canvas.updated_at.desc(), Canvas.id.desc()).limit(limit + 1).subquery())
+
+    columns = (Canvas.id, Canvas.name, Canvas.owner_id, Canvas.created_at, Canvas.updated_at)
+    owned = select(*columns).where(Canvas.owner_id == user.id)
+    # invitee emails are stored lowercased, so plain equality, which the index serves
+    shared = select(*columns).where(
+        Canvas.owner_id != user.id,
+        Canvas.id.in_(select(Invitation.canvas_id).where(Invitation.invitee_email == user.email.lower())),
+    )
+    rows = union_all(page(owned), page(shared)).subquery()
+
+    selected = [rows]
+    if "invites" in fields:
+        selected.append(
+            select(func.count()).where(Invitation.canvas_id == rows.c.id).scalar_subquery().label("invites")
+        )
+    if "members" in fields:
+        # the owner plus everyone invited, however many invitations each has
+        selected.append((
+            select(func.count(distinct(Invitation.invitee_email))).where(Invitation.canvas_id == rows.c.id)
+            .scalar_subquery() + 1
+        ).label("members"))
+    query = select(*selected).order_by(rows.c.updated_at.desc(), rows.c.id.desc()).limit(limit + 1)
+    result = (await db.execute(query)).mappings().all()
+
+    items = []
+    for row in result[:limit]:
+        item = dict(row, role="owner" if row["owner_id"] == user.id else "editor")
+        items.append({name: item[name] for name in fields})
+    more = len(result) > limit
+    return items, ((result[limit - 1]["updated_at"], result[limit - 1]["id"]) if more else None)
+
 async def get_canvas(db: AsyncSession, canvas_id: int):
     result = await db.execute(select(Canvas).where(Canvas.id == canvas_id))
     return result.scalars().first()
@@ -50,15 +99,18 @@ async def update_canvas(db: AsyncSession, canvas_id: int, name: str):
 async def delete_canvas(db: AsyncSession, canvas_id: int):
     canvas = await get_canvas(db, canvas_id)
     if canvas:
+        await adjust_blob_refs(db, set(), blob_refs(canvas.content))
         await db.delete(canvas)
         await db.commit()
+        access.invalidate_canvas(canvas_id)
     return canvas
 
 async def create_invitation(db: AsyncSession, canvas_id: int, email: str, expiry_hours: Optional[int] = None):
     token = secrets.token_urlsafe(32)
     inv = Invitation(
         canvas_id=canvas_id, 
-        invitee_email=email, 
+        # lowercased once here so lookups compare the indexed column as is
+        invitee_email=email.lower(),
         token=token,
         expires_at=(
             datetime.utcnow() + timedelta(hours=expiry_hours)
@@ -68,6 +120,14 @@ async def create_invitation(db: AsyncSession, canvas_id: int, email: str, expiry
     db.add(inv)
     await db.commit()
     await db.refresh(inv)
+    access.invalidate_canvas(canvas_id)
+    return inv
+
+async def set_invitation_disabled(db: AsyncSession, inv: Invitation, disabled: bool):
+    inv.disabled = disabled
+    await db.commit()
+    await db.refresh(inv)
+    access.invalidate_canvas(inv.canvas_id)
     return inv
 
 async def get_invitations_for_user(db: AsyncSession, email: str):
@@ -80,35 +140,119 @@ async def get_canvas_data(db: AsyncSession, canvas_id: int):
     canvas = await get_canvas(db, canvas_id)
     return canvas.content if canvas else None
 
-async def save_canvas_data(db: AsyncSession, canvas_id: int, data: dict):
-    canvas = await get_canvas(db, canvas_id)
-    if not canvas:
-        return None
+async def save_canvas_data(db: AsyncSession, canvas: Canvas, data: dict, blobs: Optional[dict] = None):
+    old_refs, new_refs = blob_refs(canvas.content), blob_refs(data)
+    await register_blobs(db, blobs or {})
+    await adjust_blob_refs(db, new_refs - old_refs, old_refs - new_refs)
     canvas.content = data
+    canvas.version = Canvas.version + 1
     await db.commit()
     await db.refresh(canvas)
     return canvas
 
+async def register_blobs(db: AsyncSession, blobs: dict):
+    if not blobs:
+        return
+    result = await db.execute(select(Blob.hash).where(Blob.hash.in_(list(blobs))))
+    existing = set(result.scalars().all())
+    for digest, (mime, size) in blobs.items():
+        if digest in existing:
+            continue
+        try:
+            async with db.begin_nested():
+                db.add(Blob(hash=digest, mime=mime, size=size, refcount=0))
+        except IntegrityError:
+            # another save registered the same content first
+            pass
+
+async def register_upload(db: AsyncSession, digest: str, mime: str, size: int):
+    await register_blobs(db, {digest: (mime, size)})
+    # an unreferenced blob is collected once it's old enough; restart the
+    # clock so the uploader has time to put it on a canvas
+    await db.execute(update(Blob).where(Blob.hash == digest).values(updated_at=func.now()))
+    await db.commit()
+
+async def adjust_blob_refs(db: AsyncSession, added: set, removed: set):
+    if added:
+        await db.execute(
+            update(Blob)
+            .where(Blob.hash.in_(list(added)))
+            .values(refcount=Blob.refcount + 1)
+        )
+    if removed:
+        await db.execute(
+            update(Blob)
+            .where(Blob.hash.in_(list(removed)))
+            .values(refcount=Blob.refcount - 1)
+        )
+
+async def get_blob(db: AsyncSession, digest: str):
+    result = await db.execute(select(Blob).where(Blob.hash == digest))
+    return result.scalars().first()
+
+async def write_canvas_content(db: AsyncSession, canvas_id: int, content: dict, version: int, blobs: Optional[dict] = None) -> bool:
+    # The row is locked before anything is compared, so the blob references
+    # dropped are those of the content actually replaced, whichever node
+    # wrote it.
+    result = await db.execute(
+        select(Canvas.content, Canvas.version).where(Canvas.id == canvas_id).with_for_update()
+    )
+    row = result.first()
+    if row is None or row.version >= version:
+        await db.rollback()
+        return False
+    old_refs, new_refs = blob_refs(row.content), blob_refs(content)
+    await db.execute(update(Canvas).where(Canvas.id == canvas_id).values(content=content, version=version))
+    await register_blobs(db, blobs or {})
+    await adjust_blob_refs(db, new_refs - old_refs, old_refs - new_refs)
+    await db.commit()
+    return True
+
 async def get_invitation_by_token(db: AsyncSession, token: str):
     result = await db.execute(select(Invitation).where(Invitation.token == token))
     return result.scalars().first()
 
-
-async def get_canvas_members(db: AsyncSession, canvas_id: int):
+async def record_join(db: AsyncSession, token: str, email: str) -> bool:
+    # one conditional UPDATE, committed straight away: concurrent joins on a
+    # popular link each add one, and the row lock lasts a single statement
     result = await db.execute(
-        select(Canvas)
-        .where(Canvas.id == canvas_id)
-        .options(selectinload(Canvas.invitations))
+        update(Invitation)
+        .where(Invitation.token == token)
+        .where(Invitation.invitee_email == email.lower())
+        .where(Invitation.disabled.is_(False))
+        .where(or_(Invitation.expires_at.is_(None), Invitation.expires_at >= datetime.utcnow()))
+        .values(join_count=Invitation.join_count + 1)
     )
-    canvas: Canvas = result.scalars().first()
-    if not canvas:
-        return None
+    await db.commit()
+    return result.rowcount > 0
+
+async def purge_expired_invitations(db: AsyncSession, expired_before: datetime, batch: int = 500) -> int:
+    # Only invitations nobody ever joined through: an invitation row is also
+    # what grants its invitee access, so a used one is kept as membership.
+    # Deleted in small batches so no transaction holds many row locks.
+    purged = 0
+    while True:
+        result = await db.execute(
+            select(Invitation.id, Invitation.canvas_id)
+            .where(Invitation.expires_at < expired_before)
+            .where(Invitation.join_count == 0)
+            .limit(batch)
+        )
+        rows = result.all()
+        if not rows:
+            return purged
+        await db.execute(
+            delete(Invitation)
+            .where(Invitation.id.in_([row.id for row in rows]))
+            .where(Invitation.join_count == 0)
+        )
+        await db.commit()
+        for canvas_id in {row.canvas_id for row in rows}:
+            access.invalidate_canvas(canvas_id)
+        purged += len(rows)
+        if len(rows) < batch:
+            return purged
 
-    members = []
-    members.append({"email": canvas.owner.email, "role": "owner"})
-    for inv in canvas.invitations:
-        members.append({"email": inv.invitee_email, "role": "editor"})
-    return members
 
 async def delete_invitation(db: AsyncSession, canvas_id: int, token: str):
     result = await db.execute(
@@ -121,24 +265,29 @@ async def delete_invitation(db: AsyncSession, canvas_id: int, token: str):
         return False
     await db.delete(inv)
     await db.commit()
+    access.invalidate_canvas(canvas_id)
     return True
 async def update_user_email(db: AsyncSession, user: User, current_password: str, new_email: str):
-    if not verify_password(current_password, user.hashed_password):
+    if not await verify_password_async(current_password, user.hashed_password):
         return False, "Incorrect password"
 
-    user.email = new_email
+    old_email = user.email
+    user.email = new_email.lower()
     try:
         await db.commit()
         await db.refresh(user)
+        access.invalidate_user(user.id)
+        invalidate_user(old_email)
         return True, None
     except IntegrityError:
         await db.rollback()
         return False, "This email is already in use."
     
 async def update_user_password(db: AsyncSession, user: User, current_password: str, new_password: str):
-    if not verify_password(current_password, user.hashed_password):
+    if not await verify_password_async(current_password, user.hashed_password):
         return False, "Incorrect current password"
 
-    user.hashed_password = get_password_hash(new_password)
+    user.hashed_password = await get_password_hash_async(new_password)
     await db.commit()
+    invalidate_user(user.email)
     return True, None
@@ -1,23 +1,18 @@
 import os
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import create_engine
-import pymysql
 
 
-pymysql.install_as_MySQLdb()
-
 DATABASE_URL = os.getenv("DATABASE_URL")
 SECRET_KEY = os.getenv("SECRET_KEY")
+SQL_ECHO = os.getenv("SQL_ECHO", "true").lower() in ("1", "true", "yes")
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+# creating the engine doesn't connect; nothing touches the database until the
+# first query, so importing the app works while the database is still down
+engine = create_async_engine(DATABASE_URL, echo=SQL_ECHO)
 async_session = sessionmaker(
     bind=engine,
     class_=AsyncSession,
     expire_on_commit=False,
 )
 Base = declarative_base()
-
-sync_engine = create_engine(
-  DATABASE_URL.replace("+aiomysql", "+pymysql")
-)
\ No newline at end of file
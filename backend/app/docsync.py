@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+import uuid
+
+from .documents import documents
+from .realtime import manager
+from .wire import Frame
+
+# how long a node loading a canvas waits for the others to write theirs out
+DOC_SYNC_TIMEOUT = float(os.getenv("DOC_SYNC_TIMEOUT", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentSync:
+    # Each node keeps its own copy of a live canvas and only flushes it now and
+    # then, so the database can be behind what's on the board. Before a node
+    # reads a canvas from the database it asks every other node subscribed to
+    # the room to flush its copy, and waits until all of them say they have
+    # (or the timeout passes). Edits relayed meanwhile are held by the store
+    # and replayed on top of what it reads.
+    def __init__(self, manager, documents, timeout: float = DOC_SYNC_TIMEOUT):
+        self.manager = manager
+        self.documents = documents
+        self.timeout = timeout
+        # request id -> [acks received, acks expected or None, future]
+        self.waiting: dict[str, list] = {}
+        self._tasks: set[asyncio.Task] = set()
+        manager.ephemeral["docFlush"] = self._on_request
+        manager.ephemeral["docFlushed"] = self._on_ack
+        documents.sync = self.settle
+
+    async def settle(self, canvas_id: int):
+        # the subscription carries both the replies and the edits to hold
+        self.manager.stream(canvas_id)
+        request = uuid.uuid4().hex
+        try:
+            if not await self.manager.pubsub.ready(canvas_id, self.timeout):
+                logger.warning("Loading canvas %s without syncing: no subscription", canvas_id)
+                return
+            future = asyncio.get_running_loop().create_future()
+            waiter = self.waiting[request] = [0, None, future]
+            text = Frame(message={"type": "docFlush", "payload": {"request": request}}).text
+            peers = await self.manager.pubsub.request(canvas_id, text)
+            if not peers:
+                return
+            waiter[1] = peers
+            if waiter[0] < peers:
+                try:
+                    await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(
+                        "Loading canvas %s after %d of %d nodes flushed", canvas_id, waiter[0], peers
+                    )
+        finally:
+            self.waiting.pop(request, None)
+            self.manager.retire(canvas_id)
+
+    def _on_request(self, canvas_id: int, frame: Frame):
+        payload = frame.message.get("payload")
+        if not isinstance(payload, dict) or not isinstance(payload.get("request"), str):
+            return
+        task = asyncio.create_task(self._answer(canvas_id, payload["request"]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _answer(self, canvas_id: int, request: str):
+        doc = self.documents.peek(canvas_id)
+        if doc is not None:
+            await self.documents.flush(doc)
+        text = Frame(message={"type": "docFlushed", "payload": {"request": request}}).text
+        await self.manager.pubsub.publish(canvas_id, text)
+
+    def _on_ack(self, canvas_id: int, frame: Frame):
+        payload = frame.message.get("payload")
+        if not isinstance(payload, dict) or not isinstance(payload.get("request"), str):
+            return
+        waiter = self.waiting.get(payload["request"])
+        if waiter is None:
+            return
+        waiter[0] += 1
+        # replies can beat the publish's own reply, before the count is known
+        if waiter[1] is not None and waiter[0] >= waiter[1] and not waiter[2].done():
+            waiter[2].set_result(None)
+
+
+sync = DocumentSync(manager, documents)
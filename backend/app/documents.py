@@ -0,0 +1,390 @@
+import asyncio
+import logging
+import os
+import uuid
+
+from .database import async_session
+from .blobs import blob_store
+from .strokes import compact_content
+from .spatial import Box, GridIndex, message_bounds, object_bounds, omitted_summary, stroke_bounds
+from . import crud
+
+FLUSH_INTERVAL = float(os.getenv("CANVAS_FLUSH_INTERVAL", "5"))
+FLUSH_MAX_OPS = int(os.getenv("CANVAS_FLUSH_MAX_OPS", "200"))
+
+logger = logging.getLogger(__name__)
+
+
+def revision(version: int) -> str:
+    # names a version as stored in the database
+    return f"v{version}"
+
+
+class VersionConflict(Exception):
+    def __init__(self, current: int):
+        super().__init__(f"Canvas is at version {current}")
+        self.current = current
+
+
+class CanvasDocument:
+    def __init__(self, canvas_id: int, content: dict | None, version: int = 0):
+        self.canvas_id = canvas_id
+        self.version = version
+        # the version this copy last read from or wrote to the database
+        self.stored_version = version
+        # Versions past that are only counted in this copy, and a crash or
+        # another node's copy can reuse the numbers for other content, so
+        # they're qualified by something unique to this load.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.connections = 0
+        self.pending_ops = 0
+        self.dirty = False
+        self.lock = asyncio.Lock()
+        self._load(content or {})
+
+    @property
+    def revision(self) -> str:
+        if not self.dirty and self.version == self.stored_version:
+            return revision(self.version)
+        return f"{revision(self.version)}-{self.epoch}"
+
+    def _load(self, content: dict):
+        content = dict(content)
+        objects = content.pop("objects", None) or []
+        strokes = content.pop("strokes", None) or []
+        self.extra = content
+        # keyed by object id so updates and deletes don't scan the whole board;
+        # dicts keep insertion order, which is the z-order the client draws in
+        self.objects: dict[str, dict] = {}
+        self.index = GridIndex()
+        for obj in objects:
+            self._put_object(self._key(obj), obj)
+        self.strokes: list[dict] = []
+        self.stroke_ids: set = set()
+        for stroke in strokes:
+            self._append_stroke(stroke)
+
+    def _key(self, obj: dict) -> str:
+        key = obj.get("id") if isinstance(obj, dict) else None
+        return str(key) if key is not None else f"__anon{len(self.objects)}"
+
+    def _put_object(self, key: str, obj: dict):
+        self.objects[key] = obj
+        self.index.add(("o", key), obj, object_bounds(obj))
+
+    def _append_stroke(self, stroke: dict):
+        # strokes have no reliable id, so the index keys them by identity
+        self.strokes.append(stroke)
+        self.index.add(("s", id(stroke)), stroke, stroke_bounds(stroke))
+        if isinstance(stroke, dict) and isinstance(stroke.get("id"), (str, int)):
+            self.stroke_ids.add(stroke["id"])
+
+    def view(self, box: Box) -> tuple[dict, dict]:
+        objects, strokes = [], []
+        for key, element in self.index.query(box):
+            (objects if key[0] == "o" else strokes).append(element)
+        summary = omitted_summary(len(self.objects), len(self.strokes), objects, strokes, self.index.extent)
+        return {**self.extra, "objects": objects, "strokes": strokes}, summary
+
+    def affected_bounds(self, message: dict) -> list[Box] | None:
+        # everywhere a message changes the board, old positions included, so
+        # viewers see objects leave as well as arrive; None means "anywhere"
+        kind, payload = message.get("type"), message.get("payload")
+        if kind == "batch" and isinstance(payload, list):
+            boxes = []
+            for part in payload:
+                part_boxes = self.affected_bounds(part) if isinstance(part, dict) else None
+                if part_boxes is None:
+                    return None
+                boxes.extend(part_boxes)
+            return boxes
+        if kind in ("objectUpdate", "objectDelete"):
+            key = str(payload.get("id")) if isinstance(payload, dict) else None
+            old = self.index.bounds(("o", key))
+            if old is None:
+                return None
+            if kind == "objectDelete":
+                return [old]
+            new = message_bounds(message)
+            return [old, *new] if new is not None else None
+        if kind == "remove_stroke":
+            boxes = [self.index.bounds(("s", id(s))) for s in self.strokes if s.get("id") == payload]
+            return boxes if boxes and None not in boxes else None
+        return message_bounds(message)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.extra,
+            "objects": list(self.objects.values()),
+            "strokes": list(self.strokes),
+        }
+
+    def adopt(self, before: dict, after: dict):
+        # swap in blob references for data URLs that were written out, unless
+        # the object changed again while the flush was running
+        if before.get("image") is not after.get("image") and self.extra.get("image") is before.get("image"):
+            self.extra["image"] = after["image"]
+        for old, new in zip(before["objects"], after["objects"]):
+            if new is not old:
+                key = self._key(old)
+                if self.objects.get(key) is old:
+                    self._put_object(key, new)
+        # likewise keep the compacted strokes so later flushes skip them
+        compacted = {id(old): new for old, new in zip(before["strokes"], after["strokes"]) if new is not old}
+        if compacted:
+            strokes = []
+            for stroke in self.strokes:
+                new = compacted.get(id(stroke))
+                if new is not None:
+                    seq, box, _ = self.index.discard(("s", id(stroke)))
+                    self.index.add(("s", id(new)), new, box, seq)
+                    stroke = new
+                strokes.append(stroke)
+            self.strokes = strokes
+
+    def replace(self, content: dict):
+        self._load(content or {})
+        self._touch()
+
+    def apply(self, message: dict) -> bool:
+        kind = message.get("type")
+        payload = message.get("payload")
+
+        if kind == "objectAdd" and isinstance(payload, dict):
+            self._put_object(self._key(payload), payload)
+        elif kind == "objectUpdate" and isinstance(payload, dict):
+            key = self._key(payload)
+            if key not in self.objects:
+                return False
+            self._put_object(key, payload)
+        elif kind == "objectDelete" and isinstance(payload, dict):
+            key = str(payload.get("id"))
+            if self.objects.pop(key, None) is None:
+                return False
+            self.index.discard(("o", key))
+        elif kind == "strokeAdd" and isinstance(payload, dict):
+            # by id, so a relayed stroke replayed after a load isn't doubled
+            if payload.get("id") in self.stroke_ids:
+                return False
+            self._append_stroke(payload)
+        elif kind == "imageReplace":
+            self.extra["image"] = payload
+        elif kind == "snapshot" and isinstance(payload, dict):
+            # the whole board, replaced through the REST API
+            self._load(payload.get("content") or {})
+        elif kind == "remove_stroke":
+            kept = []
+            for stroke in self.strokes:
+                if stroke.get("id") == payload:
+                    self.index.discard(("s", id(stroke)))
+                else:
+                    kept.append(stroke)
+            if len(kept) == len(self.strokes):
+                return False
+            self.strokes = kept
+            self.stroke_ids.discard(payload)
+        else:
+            # "draw" and anything unknown is ephemeral and never persisted
+            return False
+
+        self._touch()
+        return True
+
+    def _touch(self):
+        self.dirty = True
+        self.pending_ops += 1
+        self.version += 1
+
+
+class DocumentStore:
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, flush_max_ops: int = FLUSH_MAX_OPS):
+        self.flush_interval = flush_interval
+        self.flush_max_ops = flush_max_ops
+        self.documents: dict[int, CanvasDocument] = {}
+        self._loading: dict[int, asyncio.Future] = {}
+        # ops relayed from other nodes while a canvas is being loaded here
+        self._backlog: dict[int, list[dict]] = {}
+        # async (canvas_id) -> None, awaited before loading a canvas from the
+        # database so other nodes can write out their live copy first
+        self.sync = None
+        self._tasks: set[asyncio.Task] = set()
+        self._flusher: asyncio.Task | None = None
+
+    def peek(self, canvas_id: int) -> CanvasDocument | None:
+        return self.documents.get(canvas_id)
+
+    async def get(self, canvas_id: int) -> CanvasDocument | None:
+        doc = self.documents.get(canvas_id)
+        if doc is not None:
+            return doc
+
+        pending = self._loading.get(canvas_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[canvas_id] = future
+        self._backlog[canvas_id] = []
+        try:
+            if self.sync is not None:
+                await self.sync(canvas_id)
+            async with async_session() as db:
+                canvas = await crud.get_canvas(db, canvas_id)
+            doc = CanvasDocument(canvas_id, canvas.content, canvas.version or 0) if canvas else None
+            if doc is not None:
+                # Ops that arrived since the sync started may or may not be in
+                # what was just read. Every op sets or removes one element, so
+                # replaying them in order lands on the same board either way.
+                for message in self._backlog.get(canvas_id, ()):
+                    self._apply(doc, message)
+                self.documents[canvas_id] = doc
+            future.set_result(doc)
+            return doc
+        except BaseException as exc:
+            future.set_exception(exc)
+            # mark retrieved so a load nobody else awaited doesn't warn
+            future.exception()
+            raise
+        finally:
+            del self._loading[canvas_id]
+            self._backlog.pop(canvas_id, None)
+
+    async def open(self, canvas_id: int) -> CanvasDocument | None:
+        doc = await self.get(canvas_id)
+        if doc is not None:
+            doc.connections += 1
+        return doc
+
+    async def close(self, canvas_id: int):
+        doc = self.documents.get(canvas_id)
+        if doc is None:
+            return
+        doc.connections -= 1
+        await self.release(doc)
+
+    async def release(self, doc: CanvasDocument):
+        if doc.connections > 0:
+            return
+        await self.flush(doc)
+        # someone may have reconnected or edited while we were writing
+        if doc.connections <= 0 and not doc.dirty and self.documents.get(doc.canvas_id) is doc:
+            del self.documents[doc.canvas_id]
+
+    def apply(self, canvas_id: int, message: dict) -> bool:
+        doc = self.documents.get(canvas_id)
+        if doc is None:
+            backlog = self._backlog.get(canvas_id)
+            if backlog is not None:
+                backlog.append(message)
+            return False
+        if not self._apply(doc, message):
+            return False
+        self._maybe_flush(doc)
+        return True
+
+    def _apply(self, doc: CanvasDocument, message: dict) -> bool:
+        if message.get("type") == "batch" and isinstance(message.get("payload"), list):
+            return any([doc.apply(part) for part in message["payload"] if isinstance(part, dict)])
+        return doc.apply(message)
+
+    def affected_bounds(self, canvas_id: int, message: dict) -> list[Box] | None:
+        # call before apply(), while the old positions are still indexed
+        doc = self.documents.get(canvas_id)
+        return doc.affected_bounds(message) if doc is not None else message_bounds(message)
+
+    async def patch(self, canvas_id: int, base_version: int, ops: list[dict]) -> tuple[CanvasDocument, list[dict]] | None:
+        # returns the ops that changed something, for the caller to relay
+        doc = await self.get(canvas_id)
+        if doc is None:
+            return None
+        try:
+            if doc.version != base_version:
+                raise VersionConflict(doc.version)
+            applied = [op for op in ops if doc.apply(op)]
+        finally:
+            if doc.connections <= 0:
+                await self.release(doc)
+            else:
+                self._maybe_flush(doc)
+        return doc, applied
+
+    async def replace(self, canvas_id: int, content: dict) -> CanvasDocument | None:
+        # written through straight away, live room or not
+        doc = await self.get(canvas_id)
+        if doc is None:
+            return None
+        doc.replace(content)
+        if doc.connections <= 0:
+            await self.release(doc)
+        else:
+            await self.flush(doc)
+        return doc
+
+    def discard(self, canvas_id: int):
+        self.documents.pop(canvas_id, None)
+
+    def _maybe_flush(self, doc: CanvasDocument):
+        if doc.pending_ops >= self.flush_max_ops and not doc.lock.locked():
+            self._spawn(self.flush(doc))
+
+    async def flush(self, doc: CanvasDocument):
+        async with doc.lock:
+            if not doc.dirty:
+                return
+            content = doc.snapshot()
+            version = doc.version
+            doc.dirty = False
+            doc.pending_ops = 0
+            try:
+                compacted = await asyncio.to_thread(compact_content, content)
+                stored, created = await blob_store.externalize(compacted)
+                async with async_session() as db:
+                    # only over an older stored version: a node whose copy fell
+                    # behind must not undo what a more current one wrote
+                    written = await crud.write_canvas_content(db, doc.canvas_id, stored, version, created)
+            except Exception:
+                doc.dirty = True
+                logger.exception("Failed to flush canvas %s", doc.canvas_id)
+                return
+            except BaseException:
+                # cancelled partway: nothing is known to have been stored
+                doc.dirty = True
+                raise
+            if not written:
+                logger.warning("Canvas %s not flushed: the stored copy is newer than version %d", doc.canvas_id, version)
+                return
+            doc.stored_version = version
+            doc.adopt(content, stored)
+
+    async def flush_all(self):
+        for doc in list(self.documents.values()):
+            await self.flush(doc)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush_all()
+
+
+documents = DocumentStore()
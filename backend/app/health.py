@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+import random
+
+from sqlalchemy import text
+
+from . import migrate
+from .database import engine
+
+DB_RETRY_MAX_DELAY = float(os.getenv("DB_RETRY_MAX_DELAY", "30"))
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class NotReady(Exception):
+    pass
+
+
+def _describe(exc: Exception) -> str:
+    # the driver's own error, without SQLAlchemy's statement and help link
+    exc = getattr(exc, "orig", None) or exc
+    return str(exc) or type(exc).__name__
+
+
+class Readiness:
+    # the app starts serving right away; this watches for the database in the
+    # background and /readyz reports 503 until it is reachable and migrated
+    def __init__(self):
+        self.ready = False
+        self.reason = "starting"
+        self.attempts = 0
+        self._task: asyncio.Task | None = None
+
+    async def check(self):
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            if not self.ready:
+                version = await conn.run_sync(migrate.current_version)
+                if version < migrate.LATEST:
+                    raise NotReady(f"schema at version {version}, need {migrate.LATEST}; run python -m app.migrate")
+
+    async def _wait(self):
+        delay = 0.5
+        while True:
+            self.attempts += 1
+            try:
+                await asyncio.wait_for(self.check(), READY_CHECK_TIMEOUT)
+            except Exception as exc:
+                self.reason = _describe(exc)
+                logger.warning("Database not ready (attempt %d): %s", self.attempts, self.reason)
+            else:
+                self.ready = True
+                self.reason = "ok"
+                logger.info("Database ready after %d attempt(s)", self.attempts)
+                return
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, DB_RETRY_MAX_DELAY)
+
+    async def probe(self) -> tuple[bool, str]:
+        if not self.ready:
+            return False, self.reason
+        try:
+            await asyncio.wait_for(self.check(), READY_CHECK_TIMEOUT)
+        except Exception as exc:
+            return False, _describe(exc)
+        return True, "ok"
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._wait())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+readiness = Readiness()
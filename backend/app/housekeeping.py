@@ -0,0 +1,26 @@
+import os
+from datetime import datetime, timedelta
+
+from . import crud
+from .blobs import blob_store, BLOB_GC_INTERVAL
+from .database import async_session
+from .scheduler import scheduler
+from .uploads import uploads, UPLOAD_TTL
+
+INVITE_PURGE_INTERVAL = float(os.getenv("INVITE_PURGE_INTERVAL", "3600"))
+# how long past its expiry an unused invitation is kept before it is deleted
+INVITE_RETENTION = float(os.getenv("INVITE_RETENTION", str(7 * 86400)))
+
+
+async def purge_invitations() -> int:
+    async with async_session() as db:
+        cutoff = datetime.utcnow() - timedelta(seconds=INVITE_RETENTION)
+        return await crud.purge_expired_invitations(db, cutoff)
+
+
+scheduler.add("blob-gc", BLOB_GC_INTERVAL, blob_store.collect_garbage)
+# unless BLOB_DIR is shared, the row GC's worker can't reach the others' files
+scheduler.add("blob-sweep", BLOB_GC_INTERVAL, blob_store.sweep_files, exclusive=False)
+scheduler.add("invitation-purge", INVITE_PURGE_INTERVAL, purge_invitations)
+# part files live on this node's disk, so every worker sweeps its own
+scheduler.add("upload-expiry", min(UPLOAD_TTL, 3600), uploads.expire, exclusive=False)
@@ -1,6 +1,8 @@
+import asyncio
+import base64
+import json
 import time
 from contextlib import asynccontextmanager
-from collections import defaultdict
 from datetime import datetime
 from typing import List
 
@@ -12,45 +14,79 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
     Query,
+    Request,
+    Response,
 )
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 
-from sqlalchemy import text
-from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
 
 from . import models, schemas, crud, auth
-from .database import async_session, sync_engine, Base
+from .database import async_session, engine
 from .auth import oauth2_scheme, decode_token
-from .schemas import InvitationCreate, CanvasData, ChangeEmail, ChangePassword, InviteOut
+from .documents import documents, revision, VersionConflict
+from .blobs import blob_store, blob_url, safe_mime, DIGEST_RE
+from .realtime import (
+    manager,
+    REAUTH_INTERVAL,
+    MAX_MESSAGE_BYTES,
+    EPHEMERAL_TYPES,
+    CLOSE_TOO_LARGE,
+    CLOSE_UNSUPPORTED,
+    CLOSE_RATE_LIMITED,
+)
+from .access import access
+from .compression import CompressionMiddleware
+from .wire import Frame
+from .strokes import expand_content
+from .spatial import coerce_box, filter_content
+from .thumbnails import thumbnails
+from .health import readiness
+from .presence import presence, PRESENCE_MAX_BYTES
+from .docsync import sync as document_sync
+from .housekeeping import scheduler
+from .uploads import uploads, parse_content_range, Busy, UploadError, UPLOAD_CHUNK_BYTES, UPLOAD_MAX_BYTES
+from . import metrics, profiling
+from .schemas import (
+    InvitationCreate,
+    CanvasData,
+    CanvasPatch,
+    CanvasPatchResult,
+    ChangeEmail,
+    ChangePassword,
+    InviteOut,
+)
 from .crud import (
     get_canvas,
     create_invitation,
     get_invitations_for_user,
-    get_canvas_data,
-    save_canvas_data,
     get_invitation_by_token,
-    get_user_by_email,
     update_user_email,
     update_user_password,
 )
 
-Base.metadata.create_all(bind=sync_engine)
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    for _ in range(10):
-        try:
-            with sync_engine.connect() as conn:
-                conn.execute(text("SELECT 1"))
-            break
-        except OperationalError:
-            time.sleep(2)
-    Base.metadata.create_all(bind=sync_engine)
+    # schema changes are a separate step (python -m app.migrate); here the
+    # database is only probed in the background, so startup never waits on it
+    readiness.start()
+    documents.start()
+    scheduler.start()
+    await manager.start()
+    presence.start()
     yield
-    sync_engine.dispose()
+    await presence.stop()
+    await manager.stop()
+    await scheduler.stop()
+    await documents.stop()
+    await readiness.stop()
+    auth.hash_pool.shutdown()
+    thumbnails.shutdown()
+    await engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -59,12 +95,48 @@ app.add_middleware(
     allow_origins=["http://localhost:5173"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(engine)
+# opt-in: without PROFILE_TOKEN or PROFILE_SAMPLE_RATE nothing is installed
+if profiling.enabled():
+    app.add_middleware(profiling.ProfilingMiddleware)
+    profiling.instrument_engine(engine)
+
+@app.exception_handler(auth.HashPoolSaturated)
+async def hash_pool_saturated_handler(request: Request, exc: auth.HashPoolSaturated):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server is busy, please retry shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    # without the offending input: a NaN in it can't be written back out as JSON
+    errors = [{k: v for k, v in error.items() if k != "input"} for error in exc.errors()]
+    return JSONResponse(
+        status_code=422,
+        content={"detail": jsonable_encoder(errors)},
+    )
 
 async def get_db():
     async with async_session() as session:
         yield session
 
+async def resolve_user(db: AsyncSession, email: str, token: str) -> auth.Principal | None:
+    key = (email, token)
+    principal = auth.user_cache.get(key)
+    if principal is None:
+        user = await crud.get_user_by_email(db, email)
+        if not user:
+            return None
+        principal = auth.Principal(id=user.id, email=user.email)
+        auth.user_cache.set(key, principal)
+    return principal
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db)
@@ -72,11 +144,54 @@ async def get_current_user(
     email = decode_token(token)
     if not email:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    user = await crud.get_user_by_email(db, email)
+    user = await resolve_user(db, email, token)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     return user
 
+async def authorize_canvas(
+    db: AsyncSession,
+    canvas_id: int,
+    user,
+    load: bool = True,
+    with_content: bool = True,
+    forbidden_status: int = 404,
+):
+    allowed, canvas = await access.authorize(db, canvas_id, user, load, with_content)
+    if allowed is None:
+        raise HTTPException(status_code=404, detail="Canvas not found")
+    if not allowed:
+        detail = "Forbidden" if forbidden_status == 403 else "Not found"
+        raise HTTPException(status_code=forbidden_status, detail=detail)
+    return canvas
+
+@app.get("/healthz")
+async def api_healthz():
+    # liveness: the process is up and serving, whatever the database is doing
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def api_readyz():
+    ok, reason = await readiness.probe()
+    return JSONResponse({"status": "ok" if ok else "unavailable", "reason": reason}, status_code=200 if ok else 503)
+
+@app.get("/stats")
+async def api_stats():
+    return {
+        "caches": {
+            "users": auth.user_cache.stats(),
+            "canvas_access": access.cache.stats(),
+        },
+        "password_hashing": auth.hash_pool.stats(),
+        "thumbnails": thumbnails.stats(),
+        "media": uploads.stats(),
+        "jobs": scheduler.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def api_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/signup", response_model=schemas.Token)
 async def signup(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     if await crud.get_user_by_email(db, user.email):
@@ -84,15 +199,15 @@ async def signup(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     new_user = await crud.create_user(db, user.email, user.password)
     if not new_user:
         raise HTTPException(status_code=400, detail="Could not create user")
-    access_token = auth.create_access_token(data={"sub": user.email})
+    access_token = auth.create_access_token(data={"sub": new_user.email})
     return {"access_token": access_token}
 
 @app.post("/login", response_model=schemas.Token)
 async def login(user: schemas.UserLogin, db: AsyncSession = Depends(get_db)):
     existing = await crud.get_user_by_email(db, user.email)
-    if not existing or not auth.verify_password(user.password, existing.hashed_password):
+    if not existing or not await auth.verify_password_async(user.password, existing.hashed_password):
         raise HTTPException(status_code=400, detail="Invalid email or password")
-    access_token = auth.create_access_token(data={"sub": user.email})
+    access_token = auth.create_access_token(data={"sub": existing.email})
     return {"access_token": access_token}
 
 @app.post("/canvases", response_model=schemas.Canvas)
@@ -126,19 +241,16 @@ async def api_get_canvas(
     db: AsyncSession = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    result = await db.execute(
-        select(models.Canvas)
-        .options(selectinload(models.Canvas.invitations))
-        .where(models.Canvas.id == canvas_id)
-    )
-    canvas = result.scalars().first()
-    if not canvas:
-        raise HTTPException(status_code=404, detail="Canvas not found")
+    return await authorize_canvas(db, canvas_id, current_user, with_content=False)
 
-    invited = [inv.invitee_email.lower() for inv in canvas.invitations]
-    if not (canvas.owner_id == current_user.id or current_user.email.lower() in invited):
-        raise HTTPException(status_code=404, detail="Not found")
-    return canvas
+@app.get("/canvases/{canvas_id}/presence", response_model=schemas.CanvasPresence)
+async def api_canvas_presence(
+    canvas_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    await authorize_canvas(db, canvas_id, current_user, load=False)
+    return {"members": presence.roster(canvas_id)}
 
 @app.patch("/canvases/{canvas_id}", response_model=schemas.Canvas)
 async def api_update_canvas(
@@ -161,7 +273,9 @@ async def api_delete_canvas(
     canvas = await crud.get_canvas(db, canvas_id)
     if not canvas or canvas.owner_id != current_user.id:
         raise HTTPException(status_code=404, detail="Canvas not found or unauthorized")
+    documents.discard(canvas_id)
     await crud.delete_canvas(db, canvas_id)
+    await thumbnails.invalidate(canvas_id)
     return
 
 
@@ -214,10 +328,7 @@ async def disable_invite(
     if not inv or inv.canvas_id != canvas_id:
         raise HTTPException(404, "Invitation not found")
 
-    inv.disabled = True
-    await db.commit()
-    await db.refresh(inv)
-    return inv
+    return await crud.set_invitation_disabled(db, inv, True)
 
 @app.patch("/canvases/{canvas_id}/invite/{token}/activate", response_model=schemas.InviteOut)
 async def activate_invite(
@@ -234,10 +345,7 @@ async def activate_invite(
     if not inv or inv.canvas_id != canvas_id:
         raise HTTPException(404, "Invitation not found")
 
-    inv.disabled = False
-    await db.commit()
-    await db.refresh(inv)
-    return inv
+    return await crud.set_invitation_disabled(db, inv, False)
 
 @app.delete(
     "/canvases/{canvas_id}/invite/{token}",
@@ -265,6 +373,36 @@ async def list_invitations(
 ):
     return await get_invitations_for_user(db, current_user.email)
 
+def encode_cursor(position) -> str:
+    updated_at, canvas_id = position
+    raw = json.dumps([updated_at.isoformat(), canvas_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        updated_at, canvas_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(updated_at), int(canvas_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/dashboard", response_model=schemas.Dashboard, response_model_exclude_unset=True)
+async def api_dashboard(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = Query(None, max_length=256, description="next_cursor from the previous page"),
+    fields: str | None = Query(None, description="comma-separated subset of " + ",".join(crud.DASHBOARD_FIELDS)),
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    selected = crud.DASHBOARD_FIELDS
+    if fields:
+        selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        unknown = set(selected) - set(crud.DASHBOARD_FIELDS)
+        if unknown or not selected:
+            raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(sorted(unknown)) or '(none given)'}")
+    after = decode_cursor(cursor) if cursor else None
+    items, last = await crud.get_dashboard(db, current_user, limit, after, selected)
+    return {"items": items, "next_cursor": encode_cursor(last) if last else None}
+
 @app.get("/join/{token}", response_model=schemas.Canvas)
 async def join_canvas(
     token: str,
@@ -284,33 +422,108 @@ async def join_canvas(
     if inv.expires_at and inv.expires_at < datetime.utcnow():
         raise HTTPException(status_code=403, detail="Invitation has expired")
 
-    inv.join_count += 1
-    await db.commit()
+    # the checks above only pick the error; the update re-checks them itself
+    if not await crud.record_join(db, token, current_user.email):
+        raise HTTPException(status_code=403, detail="Invitation is no longer valid")
 
     canvas = await crud.get_canvas(db, inv.canvas_id)
     if not canvas:
         raise HTTPException(status_code=404, detail="Canvas not found")
     return canvas
 
+def canvas_etag(canvas_id: int, rev: str, paths: str = "legacy") -> str:
+    # weak: the same version may be sent with different content codings
+    suffix = "-compact" if paths == "compact" else ""
+    return f'W/"canvas-{canvas_id}-{rev}{suffix}"'
+
+async def present_content(content: dict | None, paths: str) -> dict | None:
+    # strokes are stored compact; most clients still draw from {x, y} paths
+    if paths == "compact":
+        return content
+    return await asyncio.to_thread(expand_content, content)
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
 @app.get("/canvases/{canvas_id}/data", response_model=CanvasData)
 async def api_get_canvas_data(
     canvas_id: int,
+    request: Request,
+    response: Response,
+    paths: str = Query("legacy", pattern="^(legacy|compact)$"),
+    bbox: str | None = Query(None, description="x0,y0,x1,y1: only return elements in this area"),
     db: AsyncSession = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    result = await db.execute(
-        select(models.Canvas)
-        .options(selectinload(models.Canvas.invitations))
-        .where(models.Canvas.id == canvas_id)
+    try:
+        box = coerce_box(bbox)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="bbox must be four numbers: x0,y0,x1,y1")
+    doc = documents.peek(canvas_id)
+    if_none_match = request.headers.get("if-none-match")
+    # a revalidating client usually needs only the version, not the content
+    canvas = await authorize_canvas(
+        db, canvas_id, current_user, load=doc is None, with_content=not if_none_match
     )
-    canvas = result.scalars().first()
-    if not canvas:
-        raise HTTPException(status_code=404, detail="Canvas not found")
-    invited = [inv.invitee_email.lower() for inv in canvas.invitations]
-    if not (canvas.owner_id == current_user.id or current_user.email.lower() in invited):
-        raise HTTPException(status_code=404, detail="Not found")
-    content = await get_canvas_data(db, canvas_id)
-    return {"content": content}
+    version = doc.version if doc is not None else canvas.version
+    rev = doc.revision if doc is not None else revision(version)
+    etag = canvas_etag(canvas_id, rev, paths)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    response.headers.update(headers)
+    omitted = session = None
+    if doc is not None:
+        content, omitted = doc.view(box) if box is not None else (doc.snapshot(), None)
+        # the op stream position this copy is at, for the socket to carry on
+        # from; taken together with it, so nothing falls in between
+        stream = manager.streams.get(canvas_id)
+        if stream is not None:
+            session = f"{stream.epoch}:{stream.seq}"
+    else:
+        if if_none_match:
+            await db.refresh(canvas, ["content"])
+        content = canvas.content
+        if box is not None:
+            content, omitted = filter_content(content, box)
+    return {
+        "content": await present_content(content, paths),
+        "version": version,
+        "omitted": omitted,
+        "session": session,
+    }
+
+@app.get("/canvases/{canvas_id}/thumbnail")
+async def api_get_canvas_thumbnail(
+    canvas_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    doc = documents.peek(canvas_id)
+    canvas = await authorize_canvas(db, canvas_id, current_user, load=doc is None, with_content=False)
+    rev = doc.revision if doc is not None else revision(canvas.version)
+    # renders are keyed by revision, so a save makes the old one unreachable
+    etag = f'"thumb-{canvas_id}-{rev}-{thumbnails.width}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    path = thumbnails.cached(canvas_id, rev)
+    if path is None:
+        if doc is not None:
+            content = doc.snapshot()
+        else:
+            await db.refresh(canvas, ["content"])
+            content = canvas.content
+        path = await thumbnails.render(canvas_id, rev, content)
+    return FileResponse(path, media_type=thumbnails.media_type, headers=headers)
 
 @app.post("/canvases/{canvas_id}/data", response_model=CanvasData)
 async def api_save_canvas_data(
@@ -319,73 +532,298 @@ async def api_save_canvas_data(
     db: AsyncSession = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    result = await db.execute(
-        select(models.Canvas)
-        .options(selectinload(models.Canvas.invitations))
-        .where(models.Canvas.id == canvas_id)
-    )
-    canvas = result.scalars().first()
-    if not canvas:
+    await authorize_canvas(db, canvas_id, current_user, load=False, forbidden_status=403)
+    # the store writes on its own connection; don't sit on this one meanwhile
+    await db.rollback()
+
+    # through the document store even when nobody has the board open here, so
+    # rooms on this node and others pick up the new board like any other edit
+    doc = await documents.replace(canvas_id, payload.content)
+    if doc is None:
         raise HTTPException(status_code=404, detail="Canvas not found")
-    invited = [inv.invitee_email.lower() for inv in canvas.invitations]
-    if not (canvas.owner_id == current_user.id or current_user.email.lower() in invited):
-        raise HTTPException(status_code=403, detail="Forbidden")
+    result = {"content": await present_content(doc.snapshot(), "legacy"), "version": doc.version}
+    await manager.broadcast(canvas_id, Frame(message={"type": "snapshot", "payload": result}))
+    return result
 
-    updated = await save_canvas_data(db, canvas_id, payload.content)
-    return {"content": updated.content}
+@app.patch("/canvases/{canvas_id}/data", response_model=CanvasPatchResult)
+async def api_patch_canvas_data(
+    canvas_id: int,
+    payload: CanvasPatch,
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    await authorize_canvas(db, canvas_id, current_user, load=False, forbidden_status=403)
+    await db.rollback()
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[int, list[WebSocket]] = defaultdict(list)
+    ops = [op.model_dump() for op in payload.ops]
+    try:
+        patched = await documents.patch(canvas_id, payload.base_version, ops)
+    except VersionConflict as exc:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"message": "Canvas has changed since base_version", "version": exc.current},
+        )
+    if patched is None:
+        raise HTTPException(status_code=404, detail="Canvas not found")
+    doc, applied = patched
+    if applied:
+        # same path as socket edits: local rooms, other nodes, the replay buffer
+        await manager.broadcast(canvas_id, Frame.batch([Frame(message=op) for op in applied]))
+    return {"version": doc.version, "applied": len(applied)}
+
+@app.get("/blobs/{digest}")
+async def api_get_blob(
+    digest: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+):
+    # blob URLs are unguessable content hashes embedded in canvases the
+    # caller could already read, so they are served like static files
+    if not DIGEST_RE.match(digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        # same origin as the app: never let a blob be run as a page
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "default-src 'none'; sandbox",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    blob = await crud.get_blob(db, digest)
+    if not blob or not blob_store.exists(digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    if not safe_mime(blob.mime):
+        # stored before the type allowlist existed
+        headers["Content-Disposition"] = "attachment"
+    try:
+        await uploads.downloads.acquire()
+    except Busy:
+        raise HTTPException(status_code=503, detail="Too many downloads in progress", headers={"Retry-After": "1"})
+    # Range requests (audio seeking, resumed downloads) are answered by
+    # FileResponse itself, streaming only the requested bytes
+    return BoundedFileResponse(
+        blob_store.path(digest), media_type=blob.mime, headers=headers, release=uploads.downloads.release
+    )
 
-    async def connect(self, canvas_id: int, ws: WebSocket):
-        await ws.accept()
-        self.active_connections[canvas_id].append(ws)
+class BoundedFileResponse(FileResponse):
+    # holds a download slot until the body is sent or the client goes away
+    def __init__(self, *args, release, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = release
 
-    def disconnect(self, canvas_id: int, ws: WebSocket):
-        self.active_connections[canvas_id].remove(ws)
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+def upload_status(meta: dict, offset: int, complete: bool = False) -> dict:
+    return {
+        "id": meta.get("id"),
+        "size": meta["size"],
+        "offset": offset,
+        "chunk_size": UPLOAD_CHUNK_BYTES,
+        "complete": complete,
+        "url": blob_url(meta["sha256"]) if complete else None,
+    }
+
+@app.post("/uploads", response_model=schemas.UploadStatus, status_code=201)
+async def api_create_upload(
+    payload: schemas.UploadCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    mime = payload.mime.lower()
+    sha256 = payload.sha256.lower()
+    if not uploads.allowed_mime(mime):
+        raise HTTPException(status_code=415, detail=f"Uploads of type {mime} are not accepted")
+    if not DIGEST_RE.match(sha256):
+        raise HTTPException(status_code=422, detail="sha256 must be 64 hex digits")
+    if not 0 < payload.size <= UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {UPLOAD_MAX_BYTES} bytes")
+    blob = await crud.get_blob(db, sha256)
+    if blob is not None and blob.size == payload.size and blob_store.exists(sha256):
+        # already stored: nothing to send
+        await crud.register_upload(db, sha256, blob.mime, blob.size)
+        return upload_status({"size": blob.size, "sha256": sha256}, blob.size, complete=True)
+    meta = await uploads.create(current_user.id, payload.size, mime, sha256, payload.filename)
+    return upload_status(meta, 0)
+
+@app.get("/uploads/{upload_id}", response_model=schemas.UploadStatus)
+async def api_get_upload(upload_id: str, current_user=Depends(get_current_user)):
+    # where to resume from after an interrupted chunk
+    loaded = await uploads.get(upload_id, current_user.id)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload_status(*loaded)
+
+@app.put("/uploads/{upload_id}", response_model=schemas.UploadStatus)
+async def api_upload_chunk(
+    upload_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    byte_range = parse_content_range(request.headers.get("content-range"))
+    if byte_range is None:
+        raise HTTPException(status_code=400, detail="Content-Range: bytes first-last/total is required")
+    chunk_sha256 = request.headers.get("x-chunk-sha256")
+    # a user cache miss checked a connection out; give it back before the
+    # chunk streams in, however long that takes
+    await db.rollback()
+    try:
+        await uploads.writes.acquire()
+    except Busy:
+        raise HTTPException(status_code=503, detail="Too many uploads in progress", headers={"Retry-After": "1"})
+    try:
+        meta, offset = await uploads.write_chunk(
+            upload_id, current_user.id, *byte_range, request.stream(), chunk_sha256=chunk_sha256
+        )
+        if offset < meta["size"]:
+            return upload_status(meta, offset)
+        if not await uploads.finish(meta):
+            raise HTTPException(status_code=422, detail="Checksum mismatch; the upload was discarded")
+    except UploadError as exc:
+        headers = {"Upload-Offset": str(exc.offset)} if exc.offset is not None else None
+        raise HTTPException(status_code=exc.status, detail=exc.detail, headers=headers)
+    finally:
+        uploads.writes.release()
+    await crud.register_upload(db, meta["sha256"], meta["mime"], meta["size"])
+    return upload_status(meta, offset, complete=True)
+
+@app.delete("/uploads/{upload_id}", status_code=204)
+async def api_cancel_upload(upload_id: str, current_user=Depends(get_current_user)):
+    if await uploads.get(upload_id, current_user.id) is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    await uploads.discard(upload_id)
+    return
+
+
+def apply_remote_message(canvas_id: int, frame: Frame):
+    # keep this node's copy of the document in step with edits made elsewhere
+    frame.bounds = documents.affected_bounds(canvas_id, frame.message)
+    documents.apply(canvas_id, frame.message)
 
-    async def broadcast(self, canvas_id: int, message: str):
-        for conn in self.active_connections[canvas_id]:
-            await conn.send_text(message)
+manager.listeners.append(apply_remote_message)
 
-manager = ConnectionManager()
+async def authorize_socket(canvas_id: int, token: str) -> bool:
+    user_email = decode_token(token)
+    if not user_email:
+        return False
+    # sockets live for hours, so never hold a pooled connection for them;
+    # on cache hits this session doesn't check one out at all
+    async with async_session() as db:
+        user = await resolve_user(db, user_email, token)
+        if not user:
+            return False
+        allowed, _ = await access.authorize(db, canvas_id, user, load=False)
+    return bool(allowed)
+
+async def resume_session(canvas_id: int, conn, since: str | None, doc):
+    stream = manager.stream(canvas_id)
+    after = stream.position(since)
+    if after is not None:
+        manager.join(canvas_id, conn, after, "replay")
+        return
+    if doc is None:
+        manager.join(canvas_id, conn, stream.seq, "fresh")
+        return
+    # no position (the REST copy may be from the database, a flush behind, or
+    # from before ops that arrived since), or the gap has left the buffer, or
+    # the client was on another node: send the board as of the current seq;
+    # anything relayed while it is being prepared stays buffered and is
+    # replayed right after it
+    while True:
+        after, version, content = stream.seq, doc.version, doc.snapshot()
+        payload = {"content": await present_content(content, "legacy"), "version": version}
+        if stream.position(f"{stream.epoch}:{after}") is not None:
+            break
+    snapshot = Frame(message={"type": "snapshot", "payload": payload}).stamped(after)
+    manager.join(canvas_id, conn, after, "snapshot", [snapshot])
 
 @app.websocket("/ws/canvas/{canvas_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     canvas_id: int,
     token: str = Query(...),
-    db: AsyncSession = Depends(get_db),
+    since: str | None = Query(None, max_length=64, description="epoch:seq from the last session, to resume"),
+    client: str | None = Query(None, max_length=64),
 ):
-    user_email = decode_token(token)
-    if not user_email:
-        await websocket.close(code=1008)
-        return
-
-    result = await db.execute(
-        select(models.Canvas)
-        .options(selectinload(models.Canvas.invitations))
-        .where(models.Canvas.id == canvas_id)
-    )
-    canvas = result.scalars().first()
-    if not canvas:
-        await websocket.close(code=1008)
-        return
-
-    invited = [inv.invitee_email.lower() for inv in canvas.invitations]
-    owner = await get_user_by_email(db, decode_token(token))
-    if not (canvas.owner_id == owner.id or user_email.lower() in invited):
+    if not await authorize_socket(canvas_id, token):
         await websocket.close(code=1008)
         return
 
-    await manager.connect(canvas_id, websocket)
+    conn = await manager.connect(canvas_id, websocket, client=client)
+    doc = None
     try:
+        doc = await documents.open(canvas_id)
+        await resume_session(canvas_id, conn, since, doc)
+        presence.join(canvas_id, conn, decode_token(token))
+        next_check = time.monotonic() + REAUTH_INTERVAL
         while True:
-            data = await websocket.receive_text()
-            await manager.broadcast(canvas_id, data)
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(data.get("code", 1000))
+            raw = data.get("bytes") if data.get("bytes") is not None else data.get("text") or ""
+            metrics.ws_bytes_in.inc(amount=len(raw))
+            if len(raw) > MAX_MESSAGE_BYTES:
+                metrics.ws_rejected.inc("too_large")
+                await websocket.close(code=CLOSE_TOO_LARGE, reason=f"message exceeds {MAX_MESSAGE_BYTES} bytes")
+                break
+            if data.get("bytes") is not None:
+                frame = Frame.from_binary(data["bytes"])
+            else:
+                frame = Frame.from_text(data.get("text") or "")
+            if frame is None:
+                # not a JSON object (or not expressible as one): a broken or
+                # hostile client, so stop rather than guess
+                metrics.ws_rejected.inc("malformed")
+                await websocket.close(code=CLOSE_UNSUPPORTED, reason="malformed message")
+                break
+            message = frame.message
+            kind = message.get("type")
+            metrics.ws_messages_in.inc(metrics.message_type(kind))
+            ephemeral = isinstance(kind, str) and kind in EPHEMERAL_TYPES
+            if not manager.admit(conn, len(raw), ephemeral):
+                if ephemeral:
+                    continue
+                await websocket.close(code=CLOSE_RATE_LIMITED, reason="edits sent too fast")
+                break
+            if time.monotonic() >= next_check:
+                if not await authorize_socket(canvas_id, token):
+                    await websocket.close(code=1008)
+                    break
+                next_check = time.monotonic() + REAUTH_INTERVAL
+            if message.get("type") == "presence":
+                # lossy and throttled; never relayed like a document op
+                if len(raw) <= PRESENCE_MAX_BYTES:
+                    presence.update(canvas_id, conn, message.get("payload"))
+                continue
+            if message.get("type") == "viewport":
+                try:
+                    conn.viewport = coerce_box(message.get("payload"))
+                except (TypeError, ValueError):
+                    pass
+                continue
+            if ephemeral and not manager.admit_to_room(canvas_id, conn):
+                continue
+            frame.bounds = documents.affected_bounds(canvas_id, message)
+            documents.apply(canvas_id, message)
+            payload = message.get("payload")
+            if message.get("type") == "objectUpdate" and isinstance(payload, dict) and "id" in payload:
+                await manager.broadcast_update(canvas_id, str(payload["id"]), frame, sender=websocket)
+                continue
+            await manager.broadcast(canvas_id, frame, sender=websocket)
     except WebSocketDisconnect:
-        manager.disconnect(canvas_id, websocket)
+        pass
+    finally:
+        presence.leave(canvas_id, conn)
+        conn.close()
+        if doc is not None:
+            await documents.close(canvas_id)
 
 @app.patch("/user/change_email")
 async def api_change_email(
@@ -393,7 +831,8 @@ async def api_change_email(
     db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user),
 ):
-    ok, err = await update_user_email(db, current_user, payload.current_password, payload.new_email)
+    user = await db.get(models.User, current_user.id)
+    ok, err = await update_user_email(db, user, payload.current_password, payload.new_email)
     if not ok:
         raise HTTPException(status_code=400, detail=err)
     return {"message": "Email updated successfully"}
@@ -404,7 +843,8 @@ async def api_change_password(
     db: AsyncSession = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    ok, err = await update_user_password(db, current_user, payload.current_password, payload.new_password)
+    user = await db.get(models.User, current_user.id)
+    ok, err = await update_user_password(db, user, payload.current_password, payload.new_password)
     if not ok:
         raise HTTPException(status_code=400, detail=err)
     return {"message": "Password updated successfully"}
\ No newline at end of file
@@ -0,0 +1,305 @@
+import bisect
+import contextvars
+import math
+import os
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+
+# per-canvas series are useful for finding hot rooms but grow with the number
+# of open canvases; set to false on very large deployments
+METRICS_PER_CANVAS = os.getenv("METRICS_PER_CANVAS", "true").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), collect=None):
+        super().__init__(name, help, labelnames)
+        self.values: defaultdict[tuple, float] = defaultdict(float)
+        # optional callable returning {labels: total}, for things that keep
+        # their own running count
+        self.collect = collect
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] += amount
+
+    def render(self) -> list[str]:
+        values = self.collect() if self.collect is not None else self.values
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), collect=None):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+        # optional callable returning {labels: value}, read at scrape time
+        self.collect = collect
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def render(self) -> list[str]:
+        values = self.collect() if self.collect is not None else self.values
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts..., +Inf count], sum
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: defaultdict[tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(self.sums[labels])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route template and status", ("method", "route", "status")
+)
+http_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route")
+)
+http_db_queries = registry.histogram(
+    "http_request_db_queries", "SQL statements executed per HTTP request", ("method", "route"), COUNT_BUCKETS
+)
+http_db_seconds = registry.histogram(
+    "http_request_db_seconds", "Time spent in SQL per HTTP request", ("method", "route")
+)
+db_queries = registry.counter("db_queries_total", "SQL statements executed", ("operation",))
+db_duration = registry.histogram("db_query_duration_seconds", "SQL statement latency", ("operation",))
+db_checkout_wait = registry.histogram(
+    "db_pool_checkout_seconds", "Time spent waiting for a pooled connection"
+)
+ws_messages_in = registry.counter("ws_messages_received_total", "WebSocket frames received", ("type",))
+ws_bytes_in = registry.counter("ws_bytes_received_total", "WebSocket payload bytes received")
+ws_messages_out = registry.counter("ws_messages_sent_total", "WebSocket frames sent")
+ws_bytes_out = registry.counter("ws_bytes_sent_total", "WebSocket payload bytes sent")
+ws_dropped = registry.counter("ws_messages_dropped_total", "Frames dropped for slow consumers")
+ws_rejected = registry.counter(
+    "ws_messages_rejected_total", "Inbound WebSocket messages refused outright", ("reason",)
+)
+ws_throttled = registry.counter(
+    "ws_messages_throttled_total", "Inbound WebSocket messages dropped by a rate limit", ("scope",)
+)
+ws_resumes = registry.counter(
+    "ws_session_starts_total", "WebSocket joins by how the client was brought up to date", ("mode",)
+)
+scheduler_runs = registry.counter(
+    "scheduler_job_runs_total", "Periodic job attempts by outcome (ok, failed, skipped)", ("job", "outcome")
+)
+ws_fanout = registry.histogram(
+    "ws_broadcast_fanout_seconds", "Time to queue one frame to every socket in a room", ("kind",)
+)
+
+# in-process caches by name, each with a stats() dict; read at scrape time
+caches: dict[str, object] = {}
+
+
+def _cache_stat(field: str):
+    return lambda: {(name,): cache.stats()[field] for name, cache in caches.items()}
+
+
+registry.counter("cache_hits_total", "Lookups answered from an in-process cache", ("cache",), collect=_cache_stat("hits"))
+registry.counter("cache_misses_total", "Lookups an in-process cache couldn't answer", ("cache",), collect=_cache_stat("misses"))
+registry.counter(
+    "cache_evictions_total", "Entries pushed out of an in-process cache by its size limit", ("cache",),
+    collect=_cache_stat("evictions"),
+)
+registry.gauge("cache_entries", "Entries held by an in-process cache", ("cache",), collect=_cache_stat("size"))
+
+
+# label values for client-chosen message types, so junk can't add series
+MESSAGE_TYPES = frozenset({
+    "draw", "strokeAdd", "remove_stroke", "objectAdd", "objectUpdate", "objectDelete",
+    "imageReplace", "batch", "viewport", "presence",
+})
+
+
+def message_type(kind) -> str:
+    return kind if isinstance(kind, str) and kind in MESSAGE_TYPES else "other"
+
+
+class RequestStats:
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+# set per HTTP request so engine events can attribute statements to it
+current_request: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+def _operation(statement: str) -> str:
+    word = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    return word if word in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+
+def instrument_engine(engine):
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        elapsed = time.perf_counter() - started
+        operation = _operation(statement)
+        db_queries.inc(operation)
+        db_duration.observe(elapsed, operation)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+    # time spent waiting for a connection: wrap the pool's internal getter,
+    # which is where QueuePool blocks once pool_size + max_overflow are out
+    pool = sync_engine.pool
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_checkout_wait.observe(time.perf_counter() - started)
+
+    pool._do_get = timed_do_get
+
+    def pool_state():
+        state = {}
+        for name in ("size", "checkedout", "overflow", "checkedin"):
+            fn = getattr(pool, name, None)
+            if callable(fn):
+                state[(name,)] = fn()
+        return state
+
+    registry.gauge("db_pool_connections", "Connection pool state", ("state",), collect=pool_state)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            # the template, not the raw path, so ids don't explode the label set
+            path = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_requests.inc(method, path, str(status_code))
+            http_duration.observe(elapsed, method, path)
+            http_db_queries.observe(stats.queries, method, path)
+            http_db_seconds.observe(stats.seconds, method, path)
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+from . import models
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+# bookkeeping lives outside Base so create_all never touches it
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(128), nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+
+# every step checks the live schema before changing it, so running one against
+# a database that already has the change (e.g. from the old create_all on
+# startup) just records it
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _has_index(conn, table: str, name: str) -> bool:
+    return any(i["name"] == name for i in inspect(conn).get_indexes(table))
+
+
+def _create_tables(*tables):
+    def step(conn):
+        models.Base.metadata.create_all(conn, tables=[t.__table__ for t in tables], checkfirst=True)
+    return step
+
+
+def _add_canvas_version(conn):
+    if not _has_column(conn, "canvases", "version"):
+        conn.execute(text("ALTER TABLE canvases ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+
+def _index_invitations_canvas_email(conn):
+    if not _has_index(conn, "invitations", "ix_invitations_canvas_email"):
+        conn.execute(text("CREATE INDEX ix_invitations_canvas_email ON invitations (canvas_id, invitee_email)"))
+
+
+def _index_dashboard(conn):
+    if not _has_index(conn, "invitations", "ix_invitations_invitee_email"):
+        conn.execute(text("CREATE INDEX ix_invitations_invitee_email ON invitations (invitee_email)"))
+    if not _has_index(conn, "canvases", "ix_canvases_owner_updated"):
+        conn.execute(text("CREATE INDEX ix_canvases_owner_updated ON canvases (owner_id, updated_at)"))
+
+
+def _lowercase_invitee_emails(conn):
+    conn.execute(text("UPDATE invitations SET invitee_email = LOWER(invitee_email)"))
+
+
+def _lowercase_user_emails(conn):
+    # one at a time, leaving alone any whose lowercase form another account
+    # already has; those need merging by hand
+    rows = conn.execute(text("SELECT id, email FROM users")).all()
+    taken = {email for _, email in rows}
+    for user_id, email in rows:
+        lowered = email.lower()
+        if lowered == email:
+            continue
+        if lowered in taken:
+            logger.warning("Leaving users.email %r (id %d) as is: %r exists", email, user_id, lowered)
+            continue
+        conn.execute(text("UPDATE users SET email = :email WHERE id = :id"), {"email": lowered, "id": user_id})
+        taken.add(lowered)
+
+
+MIGRATIONS = [
+    (1, "users, canvases and invitations", _create_tables(models.User, models.Canvas, models.Invitation)),
+    (2, "canvases.version", _add_canvas_version),
+    (3, "blobs", _create_tables(models.Blob)),
+    (4, "invitations (canvas_id, invitee_email) index", _index_invitations_canvas_email),
+    (5, "invitee_email and canvases (owner_id, updated_at) indexes", _index_dashboard),
+    (6, "scheduler_leases", _create_tables(models.SchedulerLease)),
+    (7, "lowercase invitations.invitee_email", _lowercase_invitee_emails),
+    (8, "lowercase users.email", _lowercase_user_emails),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    if not inspect(conn).has_table(schema_migrations.name):
+        return 0
+    return conn.execute(select(func.max(schema_migrations.c.version))).scalar() or 0
+
+
+def _upgrade(conn, target: int) -> list[int]:
+    schema_migrations.create(conn, checkfirst=True)
+    conn.commit()
+    applied = []
+    current = current_version(conn)
+    for version, name, step in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        logger.info("Applying migration %d: %s", version, name)
+        step(conn)
+        conn.execute(schema_migrations.insert().values(version=version, name=name))
+        conn.commit()
+        applied.append(version)
+    return applied
+
+
+async def upgrade(target: int = LATEST) -> list[int]:
+    async with engine.connect() as conn:
+        return await conn.run_sync(_upgrade, target)
+
+
+async def schema_version() -> int:
+    async with engine.connect() as conn:
+        return await conn.run_sync(current_version)
+
+
+async def _main(options) -> int:
+    try:
+        if options.check:
+            version = await schema_version()
+            print(f"schema version {version}, latest {LATEST}")
+            return 0 if version >= LATEST else 1
+        applied = await upgrade(options.target)
+        print(f"applied {applied}" if applied else "schema is up to date")
+        return 0
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or upgrade the database schema")
+    parser.add_argument("--check", action="store_true", help="exit 1 if migrations are pending, change nothing")
+    parser.add_argument("--target", type=int, default=LATEST, help="stop after this version")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    sys.exit(asyncio.run(_main(parser.parse_args())))
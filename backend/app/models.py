@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, func, JSON, Boolean, text
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, func, JSON, Boolean, Index, text
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -19,6 +19,12 @@ class Canvas(Base):
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
  
     content = Column(JSON, nullable=False)
+    version = Column(
+        Integer,
+        nullable=False,
+        default=0,
+        server_default=text("0")
+    )
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(
@@ -32,6 +38,10 @@ class Canvas(Base):
         "Invitation", back_populates="canvas", cascade="all, delete-orphan"
     )
 
+    __table_args__ = (
+        Index("ix_canvases_owner_updated", "owner_id", "updated_at"),
+    )
+
 class Invitation(Base):
     __tablename__ = "invitations"
     id = Column(Integer, primary_key=True, index=True)
@@ -54,6 +64,36 @@ class Invitation(Base):
 
     canvas = relationship("Canvas", back_populates="invitations")
 
+    __table_args__ = (
+        Index("ix_invitations_canvas_email", "canvas_id", "invitee_email"),
+        Index("ix_invitations_invitee_email", "invitee_email"),
+    )
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    hash = Column(String(64), primary_key=True)
+    mime = Column(String(128), nullable=False)
+    size = Column(Integer, nullable=False)
+    refcount = Column(
+        Integer,
+        nullable=False,
+        default=0,
+        server_default=text("0")
+    )
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(
+        DateTime(timezone=True),
+        onupdate=func.now(),
+        server_default=func.now(),
+    )
+
+class SchedulerLease(Base):
+    # which worker may run a periodic job, until when
+    __tablename__ = "scheduler_leases"
+    name = Column(String(64), primary_key=True)
+    holder = Column(String(128), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
 
 User.canvases = relationship("Canvas", back_populates="owner", cascade="all, delete-orphan")
 
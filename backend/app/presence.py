@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from .realtime import manager
+from .wire import Frame
+
+# cursors and selections go out at most this often per room, latest value only
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL_MS", "50")) / 1000
+# a cursor not moved for this long is hidden; a remote entry not refreshed for
+# this long (its node went away) is dropped
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "30"))
+# encoded size limit for one client's state
+PRESENCE_MAX_BYTES = 1024
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRoom:
+    def __init__(self):
+        # key (one per socket) -> {"user": email, "state": dict | None}
+        self.entries: dict[str, dict] = {}
+        self.seen: dict[str, float] = {}
+        # keys whose sockets are on this node; only these are published
+        self.local: set[str] = set()
+        # changes not yet sent to local sockets / other nodes; None = gone
+        self.dirty: dict[str, dict | None] = {}
+        self.outgoing: dict[str, dict | None] = {}
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class PresenceHub:
+    # Ephemeral per-room state that never enters the op stream: no sequence
+    # numbers, no replay, no ordering with edits. Updates only overwrite the
+    # latest value and are flushed on a fixed tick, so a burst of pointer
+    # moves costs one frame per tick however many arrive.
+    def __init__(self, manager, interval: float = PRESENCE_INTERVAL, ttl: float = PRESENCE_TTL):
+        self.manager = manager
+        self.interval = interval
+        self.ttl = ttl
+        self.rooms: dict[int, PresenceRoom] = {}
+        self._sweeper: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+        manager.ephemeral["presence"] = self._on_remote
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        for room in self.rooms.values():
+            if room.timer is not None:
+                room.timer.cancel()
+        self.rooms.clear()
+
+    def key(self, conn) -> str:
+        if conn.presence_key is None:
+            conn.presence_key = uuid.uuid4().hex[:12]
+        return conn.presence_key
+
+    def join(self, canvas_id: int, conn, user: str):
+        room = self.rooms.setdefault(canvas_id, PresenceRoom())
+        key = self.key(conn)
+        # everyone already here, plus the key this socket shows up under
+        conn.offer_presence(Frame(message={"type": "presence", "payload": dict(room.entries), "self": key}))
+        room.local.add(key)
+        self._set(canvas_id, room, key, {"user": user, "state": None}, local=True)
+
+    def update(self, canvas_id: int, conn, state) -> bool:
+        room = self.rooms.get(canvas_id)
+        key = conn.presence_key
+        if room is None or key not in room.local or not isinstance(state, dict):
+            return False
+        entry = room.entries[key]
+        self._set(canvas_id, room, key, {"user": entry["user"], "state": state}, local=True)
+        return True
+
+    def leave(self, canvas_id: int, conn):
+        room = self.rooms.get(canvas_id)
+        key = conn.presence_key
+        if room is None or key not in room.local:
+            return
+        room.local.discard(key)
+        self._set(canvas_id, room, key, None, local=True)
+
+    def roster(self, canvas_id: int) -> list[dict]:
+        room = self.rooms.get(canvas_id)
+        if room is None:
+            return []
+        users: dict[str, int] = {}
+        for entry in room.entries.values():
+            users[entry["user"]] = users.get(entry["user"], 0) + 1
+        return [{"email": email, "connections": count} for email, count in sorted(users.items())]
+
+    def _set(self, canvas_id: int, room: PresenceRoom, key: str, entry: dict | None, local: bool):
+        if entry is None:
+            room.entries.pop(key, None)
+            room.seen.pop(key, None)
+        else:
+            room.entries[key] = entry
+            room.seen[key] = time.monotonic()
+        room.dirty[key] = entry
+        if local:
+            room.outgoing[key] = entry
+        if room.timer is None:
+            room.timer = asyncio.get_running_loop().call_later(self.interval, self._flush, canvas_id)
+
+    def _flush(self, canvas_id: int):
+        room = self.rooms.get(canvas_id)
+        if room is None:
+            return
+        room.timer = None
+        changes, room.dirty = room.dirty, {}
+        outgoing, room.outgoing = room.outgoing, {}
+        if changes:
+            frame = Frame(message={"type": "presence", "payload": changes})
+            for conn in list(self.manager.active_connections.get(canvas_id, {}).values()):
+                conn.offer_presence(frame)
+        if outgoing:
+            self._publish(canvas_id, outgoing)
+        if not room.entries and not room.dirty:
+            del self.rooms[canvas_id]
+
+    def _publish(self, canvas_id: int, payload: dict):
+        text = Frame(message={"type": "presence", "payload": payload}).text
+        task = asyncio.create_task(self.manager.pubsub.publish(canvas_id, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _on_remote(self, canvas_id: int, frame: Frame):
+        payload = frame.message.get("payload")
+        if not isinstance(payload, dict) or not self.manager.active_connections.get(canvas_id):
+            return
+        room = self.rooms.setdefault(canvas_id, PresenceRoom())
+        now = time.monotonic()
+        for key, entry in payload.items():
+            if key in room.local:
+                continue
+            if entry is not None and not (isinstance(entry, dict) and isinstance(entry.get("user"), str)):
+                continue
+            if entry is not None and room.entries.get(key) == entry:
+                # a heartbeat: still there, nothing to send
+                room.seen[key] = now
+                continue
+            if entry is None and key not in room.entries:
+                continue
+            self._set(canvas_id, room, key, entry, local=False)
+
+    def sweep(self):
+        now = time.monotonic()
+        for canvas_id, room in list(self.rooms.items()):
+            for key in list(room.entries):
+                entry = room.entries[key]
+                idle = now - room.seen.get(key, now)
+                if key not in room.local:
+                    if idle > self.ttl:
+                        self._set(canvas_id, room, key, None, local=False)
+                elif entry["state"] is not None and idle > self.ttl:
+                    self._set(canvas_id, room, key, {"user": entry["user"], "state": None}, local=True)
+            # let other nodes know our sockets are still here
+            heartbeat = {key: room.entries[key] for key in room.local if key in room.entries}
+            if heartbeat:
+                self._publish(canvas_id, heartbeat)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Presence sweep failed")
+
+
+presence = PresenceHub(manager)
@@ -0,0 +1,243 @@
+import asyncio
+import contextvars
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from sqlalchemy import event
+
+# profiling is only installed when one of these is set; otherwise it costs nothing
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_HEADER = "x-profile"
+
+logger = logging.getLogger(__name__)
+
+
+def enabled() -> bool:
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profile:
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.route = path
+        self.status = None
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        # stack (root first) -> seconds observed on it
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.samples = 0
+        # (start offset, duration, statement) for each SQL statement
+        self.spans: list[tuple[float, float, str]] = []
+
+    def stem(self) -> str:
+        route = re.sub(r"[^A-Za-z0-9]+", "_", self.route).strip("_") or "root"
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{self.method}-{route}-{self.id}"
+
+    def collapsed(self) -> str:
+        # Brendan Gregg's folded format, weights in microseconds
+        return "".join(f"{';'.join(stack)} {round(seconds * 1e6)}\n" for stack, seconds in self.stacks.items())
+
+    def speedscope(self) -> dict:
+        frames: list[dict] = []
+        index: dict[str, int] = {}
+
+        def frame_id(name: str) -> int:
+            if name not in index:
+                index[name] = len(frames)
+                frames.append({"name": name})
+            return index[name]
+
+        samples = [[frame_id(name) for name in stack] for stack in self.stacks]
+        weights = [seconds for seconds in self.stacks.values()]
+        profiles = [{
+            "type": "sampled",
+            "name": f"{self.method} {self.path} (event loop samples)",
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": self.elapsed,
+            "samples": samples,
+            "weights": weights,
+        }]
+
+        # DB statements as an evented timeline alongside the samples
+        events = []
+        request_frame = frame_id(f"{self.method} {self.route}")
+        events.append({"type": "O", "frame": request_frame, "at": 0})
+        for start, duration, statement in self.spans:
+            frame = frame_id("SQL " + statement[:120])
+            events.append({"type": "O", "frame": frame, "at": start})
+            events.append({"type": "C", "frame": frame, "at": start + duration})
+        events.append({"type": "C", "frame": request_frame, "at": self.elapsed})
+        profiles.append({
+            "type": "evented",
+            "name": f"{self.method} {self.path} (database)",
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": self.elapsed,
+            "events": events,
+        })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "name": f"{self.method} {self.path}",
+            "exporter": "innoboard",
+        }
+
+    def summary(self) -> dict:
+        db_seconds = sum(duration for _, duration, _ in self.spans)
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "elapsed_ms": round(self.elapsed * 1000, 3),
+            "samples": self.samples,
+            "db": {
+                "statements": len(self.spans),
+                "total_ms": round(db_seconds * 1000, 3),
+                "spans": [
+                    {"start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3), "sql": statement}
+                    for start, duration, statement in self.spans
+                ],
+            },
+        }
+
+    def write(self, directory: str) -> str:
+        # runs in a worker thread once the response has gone out
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.stem())
+        with open(base + ".collapsed.txt", "w") as fh:
+            fh.write(self.collapsed())
+        with open(base + ".speedscope.json", "w") as fh:
+            json.dump(self.speedscope(), fh)
+        with open(base + ".spans.json", "w") as fh:
+            json.dump(self.summary(), fh, indent=2)
+        return base
+
+
+current_profile: contextvars.ContextVar[Profile | None] = contextvars.ContextVar("current_profile", default=None)
+
+
+class _Sampler(threading.Thread):
+    # samples the event loop thread's stack, but only while the profiled
+    # request's task is the one running, so concurrent requests don't leak in
+    def __init__(self, profile: Profile, loop: asyncio.AbstractEventLoop, task: asyncio.Task, interval: float):
+        super().__init__(daemon=True, name=f"profiler-{profile.id}")
+        self.profile = profile
+        self.loop = loop
+        self.task = task
+        self.interval = interval
+        self.target = threading.get_ident()
+        self.done = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.done.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+            if asyncio.current_task(self.loop) is not self.task:
+                continue
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.profile.stacks[tuple(reversed(stack))] += weight
+                self.profile.samples += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+def instrument_engine(engine):
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if current_profile.get() is not None:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        profile = current_profile.get()
+        started = conn.info.get("profile_started")
+        if profile is None or not started:
+            return
+        start = started.pop()
+        profile.spans.append((start - profile.started, time.perf_counter() - start, " ".join(statement.split())))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        started = context.connection.info.get("profile_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, token: str = PROFILE_TOKEN, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.app = app
+        self.token = token
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.interval = interval
+
+    def _wanted(self, scope) -> bool:
+        if self.token:
+            for name, value in scope.get("headers", []):
+                if name.lower() == PROFILE_HEADER.encode():
+                    return hmac.compare_digest(value.decode("latin-1"), self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"])
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = current_profile.set(profile)
+        sampler = _Sampler(profile, asyncio.get_running_loop(), asyncio.current_task(), self.interval)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            current_profile.reset(token)
+            profile.elapsed = time.perf_counter() - profile.started
+            route = scope.get("route")
+            profile.route = getattr(route, "path", None) or profile.path
+            try:
+                await asyncio.to_thread(profile.write, self.directory)
+            except OSError:
+                logger.exception("Failed to write profile %s", profile.id)
@@ -0,0 +1,365 @@
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+from collections import deque
+from typing import Callable
+from urllib.parse import urlparse
+
+PUBSUB_URL = os.getenv("PUBSUB_URL", "memory://")
+CHANNEL_PREFIX = os.getenv("PUBSUB_CHANNEL_PREFIX", "innoboard:canvas:")
+
+logger = logging.getLogger(__name__)
+
+MessageHandler = Callable[[int, str], None]
+
+
+# Carries room messages between nodes; each node fans out to its own sockets.
+class PubSub:
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self._on_message: MessageHandler | None = None
+
+    async def start(self, on_message: MessageHandler):
+        self._on_message = on_message
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, canvas_id: int):
+        pass
+
+    def unsubscribe(self, canvas_id: int):
+        pass
+
+    async def publish(self, canvas_id: int, message: str):
+        pass
+
+    async def ready(self, canvas_id: int, timeout: float) -> bool:
+        # whether our subscription to the room is live, waiting up to timeout
+        return True
+
+    async def request(self, canvas_id: int, message: str) -> int | None:
+        # publish and report how many other nodes received it, None if unknown
+        await self.publish(canvas_id, message)
+        return 0
+
+
+class InProcessPubSub(PubSub):
+    _nodes: set["InProcessPubSub"] = set()
+
+    def __init__(self):
+        super().__init__()
+        self._rooms: set[int] = set()
+
+    async def start(self, on_message: MessageHandler):
+        await super().start(on_message)
+        self._nodes.add(self)
+
+    async def stop(self):
+        self._nodes.discard(self)
+
+    def subscribe(self, canvas_id: int):
+        self._rooms.add(canvas_id)
+
+    def unsubscribe(self, canvas_id: int):
+        self._rooms.discard(canvas_id)
+
+    async def publish(self, canvas_id: int, message: str):
+        for node in self._nodes:
+            if node is not self and canvas_id in node._rooms:
+                node._on_message(canvas_id, message)
+
+    async def request(self, canvas_id: int, message: str) -> int | None:
+        receivers = sum(1 for node in self._nodes if node is not self and canvas_id in node._rooms)
+        await self.publish(canvas_id, message)
+        return receivers
+
+
+class RedisError(Exception):
+    pass
+
+
+def _bulk(arg) -> bytes:
+    if isinstance(arg, str):
+        arg = arg.encode()
+    elif isinstance(arg, int):
+        arg = str(arg).encode()
+    return b"$%d\r\n%s\r\n" % (len(arg), arg)
+
+
+def _encode(*args) -> bytes:
+    return b"*%d\r\n" % len(args) + b"".join(_bulk(arg) for arg in args)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        size = int(rest)
+        if size < 0:
+            return None
+        return (await reader.readexactly(size + 2))[:-2]
+    if kind == b"*":
+        size = int(rest)
+        if size < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(size)]
+    raise RedisError(f"unexpected reply {line!r}")
+
+
+class RedisPubSub(PubSub):
+    def __init__(self, url: str):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self._rooms: set[int] = set()
+        self._sub_writer: asyncio.StreamWriter | None = None
+        self._sub_task: asyncio.Task | None = None
+        self._pub_writer: asyncio.StreamWriter | None = None
+        self._pub_task: asyncio.Task | None = None
+        self._pub_lock = asyncio.Lock()
+        self._pending: deque[asyncio.Future | None] = deque()
+        # channels the server has confirmed, and who is waiting on the rest
+        self._confirmed: set[bytes] = set()
+        self._confirming: dict[bytes, list[asyncio.Future]] = {}
+
+    def _channel(self, canvas_id: int) -> str:
+        return f"{CHANNEL_PREFIX}{canvas_id}"
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode("AUTH", self.password))
+            reply = await _read_reply(reader)
+            if isinstance(reply, RedisError):
+                writer.close()
+                raise reply
+        return reader, writer
+
+    async def start(self, on_message: MessageHandler):
+        await super().start(on_message)
+        self._sub_task = asyncio.create_task(self._run_subscriber())
+
+    async def stop(self):
+        for task in (self._sub_task, self._pub_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        for writer in (self._sub_writer, self._pub_writer):
+            if writer is not None:
+                writer.close()
+        self._sub_task = self._pub_task = None
+        self._sub_writer = self._pub_writer = None
+
+    def subscribe(self, canvas_id: int):
+        self._rooms.add(canvas_id)
+        if self._sub_writer is not None:
+            self._sub_writer.write(_encode("SUBSCRIBE", self._channel(canvas_id)))
+
+    def unsubscribe(self, canvas_id: int):
+        self._rooms.discard(canvas_id)
+        self._confirmed.discard(self._channel(canvas_id).encode())
+        if self._sub_writer is not None:
+            self._sub_writer.write(_encode("UNSUBSCRIBE", self._channel(canvas_id)))
+
+    async def ready(self, canvas_id: int, timeout: float) -> bool:
+        channel = self._channel(canvas_id).encode()
+        if channel in self._confirmed:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._confirming.setdefault(channel, []).append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._confirming.get(channel, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._confirming.pop(channel, None)
+        return True
+
+    def _confirm(self, channel: bytes):
+        self._confirmed.add(channel)
+        for future in self._confirming.pop(channel, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def _run_subscriber(self):
+        delay = 0.5
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._open()
+                if self._rooms:
+                    writer.write(_encode("SUBSCRIBE", *(self._channel(c) for c in self._rooms)))
+                self._sub_writer = writer
+                delay = 0.5
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._dispatch(reply[1], reply[2])
+                    elif isinstance(reply, list) and len(reply) == 3 and reply[0] == b"subscribe":
+                        self._confirm(reply[1])
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, RedisError) as exc:
+                logger.warning("Pub/sub subscriber connection lost: %s", exc)
+            finally:
+                self._sub_writer = None
+                self._confirmed.clear()
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+    def _dispatch(self, channel: bytes, data: bytes):
+        try:
+            canvas_id = int(channel.decode()[len(CHANNEL_PREFIX):])
+            origin, message = data.split(b" ", 1)
+        except ValueError:
+            return
+        # our own publishes were already delivered to local sockets
+        if origin.decode() != self.node_id:
+            self._on_message(canvas_id, message.decode())
+
+    async def _publisher(self) -> asyncio.StreamWriter:
+        if self._pub_writer is not None:
+            return self._pub_writer
+        async with self._pub_lock:
+            if self._pub_writer is None:
+                reader, writer = await self._open()
+                self._pub_writer = writer
+                self._pub_task = asyncio.create_task(self._read_publisher(reader))
+            return self._pub_writer
+
+    async def _read_publisher(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                reply = await _read_reply(reader)
+                future = self._pending.popleft() if self._pending else None
+                if future is not None and not future.done():
+                    if isinstance(reply, RedisError):
+                        future.set_exception(reply)
+                    else:
+                        future.set_result(reply)
+                elif isinstance(reply, RedisError):
+                    logger.warning("Pub/sub command failed: %s", reply)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, RedisError) as exc:
+            logger.warning("Pub/sub publisher connection lost: %s", exc)
+        finally:
+            if self._pub_writer is not None:
+                self._pub_writer.close()
+            self._pub_writer = None
+            while self._pending:
+                future = self._pending.popleft()
+                if future is not None and not future.done():
+                    future.set_exception(ConnectionError("pub/sub connection lost"))
+
+    async def command(self, *args):
+        writer = await self._publisher()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        writer.write(_encode(*args))
+        await writer.drain()
+        return await future
+
+    async def publish(self, canvas_id: int, message: str):
+        try:
+            writer = await self._publisher()
+            # replies are pipelined; publishes don't wait for theirs
+            self._pending.append(None)
+            writer.write(_encode("PUBLISH", self._channel(canvas_id), f"{self.node_id} {message}"))
+            await writer.drain()
+        except (OSError, ConnectionError, RedisError) as exc:
+            logger.warning("Dropping pub/sub publish for canvas %s: %s", canvas_id, exc)
+
+    async def request(self, canvas_id: int, message: str) -> int | None:
+        channel = self._channel(canvas_id)
+        try:
+            receivers = await self.command("PUBLISH", channel, f"{self.node_id} {message}")
+        except (OSError, ConnectionError, RedisError) as exc:
+            logger.warning("Dropping pub/sub publish for canvas %s: %s", canvas_id, exc)
+            return None
+        # the count includes our own subscription, if the room has one
+        return receivers - (channel.encode() in self._confirmed)
+
+
+def create_pubsub(url: str = PUBSUB_URL) -> PubSub:
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return InProcessPubSub()
+    if scheme == "redis":
+        return RedisPubSub(url)
+    raise ValueError(f"Unsupported PUBSUB_URL scheme: {scheme!r}")
+
+
+# Minimal Redis-protocol pub/sub server for development and tests.
+class Broker:
+    def __init__(self):
+        self.channels: dict[bytes, set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: set[bytes] = set()
+        try:
+            while True:
+                request = await _read_reply(reader)
+                if not isinstance(request, list) or not request:
+                    break
+                name, args = request[0].upper(), request[1:]
+                if name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                    for channel in args or list(subscribed):
+                        if name == b"SUBSCRIBE":
+                            subscribed.add(channel)
+                            self.channels.setdefault(channel, set()).add(writer)
+                        else:
+                            subscribed.discard(channel)
+                            self.channels.get(channel, set()).discard(writer)
+                        writer.write(b"*3\r\n" + _bulk(name.lower()) + _bulk(channel) + b":%d\r\n" % len(subscribed))
+                elif name == b"PUBLISH" and len(args) == 2:
+                    receivers = list(self.channels.get(args[0], ()))
+                    frame = _encode("message", args[0], args[1])
+                    for receiver in receivers:
+                        receiver.write(frame)
+                    writer.write(b":%d\r\n" % len(receivers))
+                elif name in (b"PING", b"AUTH", b"SELECT"):
+                    writer.write(b"+PONG\r\n" if name == b"PING" else b"+OK\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self.channels.get(channel, set()).discard(writer)
+            writer.close()
+
+
+async def serve_broker(host: str, port: int):
+    server = await asyncio.start_server(Broker().handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local Redis-protocol pub/sub broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    options = parser.parse_args()
+    asyncio.run(serve_broker(options.host, options.port))
@@ -0,0 +1,32 @@
+import time
+
+
+class TokenBucket:
+    # refills continuously at `rate` per second up to `capacity`; a rate of 0
+    # or less means unlimited
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill(time.monotonic())
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def retry_after(self, amount: float = 1) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill(time.monotonic())
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
@@ -0,0 +1,472 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict, deque
+from itertools import islice
+
+from fastapi import WebSocket
+
+from . import metrics
+from .pubsub import PubSub, create_pubsub
+from .ratelimit import TokenBucket
+from .spatial import Box, intersects
+from .wire import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, Frame
+
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# what to do when a client can't keep up: "drop_oldest", "coalesce" or "disconnect"
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+# objectUpdates are held this long and sent as one batch frame; 0 disables
+COALESCE_MS = float(os.getenv("WS_COALESCE_MS", "33"))
+# how often a connected socket's token and canvas membership are re-checked
+REAUTH_INTERVAL = float(os.getenv("WS_REAUTH_INTERVAL", "60"))
+# relayed frames kept per room so a reconnecting client gets only what it missed
+REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "512"))
+# how long an empty room stays subscribed and keeps its replay buffer
+REPLAY_RETENTION = float(os.getenv("WS_REPLAY_RETENTION", "60"))
+
+# inbound limits, enforced whatever the client does: largest message accepted,
+# and token buckets per socket (messages and bytes) and per room (messages).
+# Sized for the shipped client, which sends a draw or objectUpdate per pointer
+# event (up to 144/s on a fast display) plus 20 presence updates a second.
+MAX_MESSAGE_BYTES = int(os.getenv("WS_MAX_MESSAGE_BYTES", str(2 * 1024 * 1024)))
+# draw, presence and viewport: past the limit they are dropped
+RATE_LIMIT = float(os.getenv("WS_RATE_LIMIT", "240"))
+RATE_BURST = float(os.getenv("WS_RATE_BURST", "480"))
+# document edits: past the limit the socket is closed, never an edit dropped
+OP_RATE_LIMIT = float(os.getenv("WS_OP_RATE_LIMIT", "300"))
+OP_RATE_BURST = float(os.getenv("WS_OP_RATE_BURST", "600"))
+BYTE_RATE_LIMIT = float(os.getenv("WS_BYTE_RATE_LIMIT", str(1024 * 1024)))
+ROOM_RATE_LIMIT = float(os.getenv("WS_ROOM_RATE_LIMIT", "2000"))
+ROOM_RATE_BURST = float(os.getenv("WS_ROOM_RATE_BURST", "4000"))
+# lossy message types; anything else is treated as a document edit
+EPHEMERAL_TYPES = frozenset({"draw", "presence", "viewport"})
+# tell a throttled client at most this often
+THROTTLE_NOTICE_INTERVAL = 1.0
+
+# "Try Again Later": the client fell too far behind, or sent edits faster than
+# they are accepted, and should reconnect
+CLOSE_SLOW_CONSUMER = 1013
+CLOSE_RATE_LIMITED = 1013
+# "Message Too Big"
+CLOSE_TOO_LARGE = 1009
+# "Unsupported Data": not a message we can parse or re-encode
+CLOSE_UNSUPPORTED = 1003
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    def __init__(
+        self,
+        ws: WebSocket,
+        on_close,
+        binary: bool = False,
+        client: str | None = None,
+        policy: str = SLOW_CONSUMER_POLICY,
+        maxsize: int = SEND_QUEUE_SIZE,
+    ):
+        self.ws = ws
+        # msgpack clients get binary frames, everyone else JSON text
+        self.binary = binary
+        # chosen by the client and kept across reconnects, so a replay can
+        # leave out what it sent itself
+        self.client = client
+        self.joined = False
+        self.presence_key: str | None = None
+        self.inbound = TokenBucket(RATE_LIMIT, RATE_BURST)
+        self.inbound_ops = TokenBucket(OP_RATE_LIMIT, OP_RATE_BURST)
+        # room for at least two maximum-size messages in a burst
+        self.inbound_bytes = TokenBucket(BYTE_RATE_LIMIT, 2 * MAX_MESSAGE_BYTES)
+        self.throttle_notice = 0.0
+        # set by the client; frames that land entirely outside it are skipped
+        self.viewport: Box | None = None
+        self.policy = policy
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._on_close = on_close
+        self._queue: deque[tuple[object, Frame]] = deque()
+        # presence has its own single slot: newer state replaces what hasn't
+        # gone out yet, and it never waits behind queued document ops
+        self._presence: Frame | None = None
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._drain())
+
+    def send(self, frame: Frame, key=None):
+        if self.closed or not self.wants(frame):
+            return
+        if len(self._queue) >= self.maxsize and not self._make_room():
+            return
+        self._queue.append((key, frame))
+        self._ready.set()
+
+    def offer_presence(self, frame: Frame):
+        if self.closed:
+            return
+        if self._presence is not None:
+            previous = self._presence.message
+            payload = {**previous["payload"], **frame.message["payload"]}
+            frame = Frame(message={**previous, **frame.message, "payload": payload})
+        self._presence = frame
+        self._ready.set()
+
+    def wants(self, frame: Frame) -> bool:
+        if self.viewport is None or frame.bounds is None:
+            return True
+        return any(intersects(self.viewport, box) for box in frame.bounds)
+
+    def _make_room(self) -> bool:
+        if self.policy == "disconnect":
+            self.close(CLOSE_SLOW_CONSUMER)
+            return False
+        if self.policy == "coalesce":
+            self._coalesce()
+        while len(self._queue) >= self.maxsize:
+            # Only live drawing can go missing. Batches, adds and deletes are
+            # the document itself: without one this copy of the board stays
+            # wrong, so the client is sent off to reconnect for a fresh one.
+            index = next(
+                (i for i, (_, frame) in enumerate(self._queue) if frame.message.get("type") in EPHEMERAL_TYPES),
+                None,
+            )
+            if index is None:
+                self.close(CLOSE_SLOW_CONSUMER)
+                return False
+            del self._queue[index]
+            self.dropped += 1
+            metrics.ws_dropped.inc()
+        return True
+
+    def _coalesce(self):
+        # keep only the newest queued message per key (e.g. per object id),
+        # in the position of the newest one
+        seen = set()
+        kept = deque()
+        for key, frame in reversed(self._queue):
+            if key is not None:
+                if key in seen:
+                    self.dropped += 1
+                    metrics.ws_dropped.inc()
+                    continue
+                seen.add(key)
+            kept.appendleft((key, frame))
+        self._queue = kept
+
+    async def _drain(self):
+        try:
+            while True:
+                while not self._queue and self._presence is None:
+                    self._ready.clear()
+                    await self._ready.wait()
+                if self._presence is not None:
+                    frame, self._presence = self._presence, None
+                else:
+                    _, frame = self._queue.popleft()
+                if self.binary:
+                    data = frame.binary
+                    await self.ws.send_bytes(data)
+                else:
+                    data = frame.text
+                    await self.ws.send_text(data)
+                metrics.ws_messages_out.inc()
+                # server-encoded JSON is ASCII, so characters are bytes
+                metrics.ws_bytes_out.inc(amount=len(data))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.debug("Dropping websocket after failed send", exc_info=True)
+            self.close()
+
+    def close(self, code: int | None = None):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._presence = None
+        if asyncio.current_task() is not self._writer:
+            self._writer.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+        self._on_close(self)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+
+class RoomStream:
+    # Numbers every frame relayed in one room on this node and keeps the most
+    # recent ones. The epoch is new each time a stream starts, so a position
+    # from an expired stream or another node is never taken for one of ours.
+    def __init__(self, size: int = REPLAY_BUFFER_SIZE):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        # (seq, [(origin client, frame), ...]); batches keep one entry per part
+        self.buffer: deque[tuple[int, list[tuple[str | None, Frame]]]] = deque(maxlen=size)
+        self.joining = 0
+        self.expiry: asyncio.TimerHandle | None = None
+
+    def record(self, parts: list[tuple[str | None, Frame]]) -> int:
+        self.seq += 1
+        self.buffer.append((self.seq, parts))
+        return self.seq
+
+    def position(self, token: str | None) -> int | None:
+        # "epoch:seq" from a client -> seq, if everything after it is still buffered
+        if not token:
+            return None
+        epoch, _, seq = token.partition(":")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        first = self.buffer[0][0] if self.buffer else self.seq + 1
+        if seq > self.seq or seq + 1 < first:
+            return None
+        return seq
+
+    def replay(self, after: int, client: str | None) -> list[Frame]:
+        if not self.buffer:
+            return []
+        frames = []
+        for seq, parts in islice(self.buffer, max(0, after + 1 - self.buffer[0][0]), None):
+            kept = [frame for origin, frame in parts if client is None or origin != client]
+            if kept:
+                frames.append(Frame.batch(kept).stamped(seq))
+        return frames
+
+
+class ConnectionManager:
+    def __init__(self, pubsub: PubSub | None = None, coalesce_ms: float = COALESCE_MS):
+        self.active_connections: dict[int, dict[WebSocket, Connection]] = defaultdict(dict)
+        # outlives the room by REPLAY_RETENTION, and so does the subscription
+        self.streams: dict[int, RoomStream] = {}
+        # inbound messages per room, across all of its sockets on this node
+        self.room_limits: dict[int, TokenBucket] = {}
+        self.pubsub = pubsub or create_pubsub()
+        self.coalesce_interval = coalesce_ms / 1000
+        # canvas_id -> object id -> (sender, origin client, frame), latest state only
+        self._pending_updates: dict[int, dict[str, tuple[WebSocket | None, str | None, Frame]]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # called with (canvas_id, frame) for messages relayed by other nodes,
+        # before they are delivered locally
+        self.listeners = []
+        # message type -> handler for relayed messages that aren't document
+        # ops and so skip the listeners and the sequenced stream
+        self.ephemeral = {}
+
+    async def start(self):
+        await self.pubsub.start(self._on_remote)
+
+    async def stop(self):
+        for canvas_id in list(self._pending_updates):
+            await self.flush_updates(canvas_id)
+        for stream in self.streams.values():
+            if stream.expiry is not None:
+                stream.expiry.cancel()
+        self.streams.clear()
+        await self.pubsub.stop()
+
+    async def connect(self, canvas_id: int, ws: WebSocket, client: str | None = None) -> Connection:
+        # accepts the socket; it gets room traffic once join() is called
+        offered = ws.scope.get("subprotocols", [])
+        subprotocol = next((p for p in (MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL) if p in offered), None)
+        await ws.accept(subprotocol=subprotocol)
+        conn = Connection(
+            ws, lambda c: self._remove(canvas_id, c), binary=subprotocol == MSGPACK_SUBPROTOCOL, client=client
+        )
+        stream = self.stream(canvas_id)
+        stream.joining += 1
+        return conn
+
+    def stream(self, canvas_id: int) -> RoomStream:
+        stream = self.streams.get(canvas_id)
+        if stream is None:
+            stream = self.streams[canvas_id] = RoomStream()
+            self.pubsub.subscribe(canvas_id)
+        elif stream.expiry is not None:
+            stream.expiry.cancel()
+            stream.expiry = None
+        return stream
+
+    def join(self, canvas_id: int, conn: Connection, after: int, mode: str, first: list[Frame] = ()):
+        # Synchronous, so nothing can be relayed between the replay and the
+        # socket entering the room: the client sees every seq after `after`
+        # exactly once (apart from its own ops).
+        if conn.closed:
+            # already let go of in _remove
+            return
+        stream = self.stream(canvas_id)
+        stream.joining -= 1
+        session = {"type": "session", "payload": {"epoch": stream.epoch, "seq": after, "mode": mode}}
+        conn.send(Frame(message=session))
+        for frame in first:
+            conn.send(frame)
+        for frame in stream.replay(after, conn.client):
+            conn.send(frame)
+        conn.joined = True
+        self.active_connections[canvas_id][conn.ws] = conn
+        metrics.ws_resumes.inc(mode)
+
+    def disconnect(self, canvas_id: int, ws: WebSocket):
+        conn = self.active_connections.get(canvas_id, {}).get(ws)
+        if conn is not None:
+            conn.close()
+
+    def _remove(self, canvas_id: int, conn: Connection):
+        room = self.active_connections.get(canvas_id)
+        if room is not None and room.get(conn.ws) is conn:
+            del room[conn.ws]
+        if not conn.joined and canvas_id in self.streams:
+            conn.joined = True
+            self.streams[canvas_id].joining -= 1
+        if not room:
+            self.active_connections.pop(canvas_id, None)
+            self.retire(canvas_id)
+
+    def retire(self, canvas_id: int):
+        stream = self.streams.get(canvas_id)
+        if stream is None or stream.expiry is not None or stream.joining > 0 or self.active_connections.get(canvas_id):
+            return
+        if REPLAY_RETENTION <= 0:
+            self._expire(canvas_id)
+        else:
+            stream.expiry = asyncio.get_running_loop().call_later(REPLAY_RETENTION, self._expire, canvas_id)
+
+    def _expire(self, canvas_id: int):
+        stream = self.streams.get(canvas_id)
+        if stream is None or stream.joining > 0 or self.active_connections.get(canvas_id):
+            return
+        del self.streams[canvas_id]
+        self.room_limits.pop(canvas_id, None)
+        self.pubsub.unsubscribe(canvas_id)
+
+    def admit(self, conn: Connection, size: int, ephemeral: bool) -> bool:
+        # An ephemeral message over the limit is dropped and the client told
+        # so. An edit can't be: the sender has already drawn it, so the caller
+        # closes the socket and the client comes back with the whole board.
+        if not ephemeral:
+            if conn.inbound_ops.take() and conn.inbound_bytes.take(size):
+                return True
+            metrics.ws_rejected.inc("rate_limited")
+            return False
+        if conn.inbound.take() and conn.inbound_bytes.take(size):
+            return True
+        retry = max(conn.inbound.retry_after(), conn.inbound_bytes.retry_after(size))
+        self._throttled(conn, "connection", retry)
+        return False
+
+    def admit_to_room(self, canvas_id: int, conn: Connection) -> bool:
+        # relayed ephemeral messages only
+        bucket = self.room_limits.get(canvas_id)
+        if bucket is None:
+            bucket = self.room_limits[canvas_id] = TokenBucket(ROOM_RATE_LIMIT, ROOM_RATE_BURST)
+        if bucket.take():
+            return True
+        self._throttled(conn, "room", bucket.retry_after())
+        return False
+
+    def _throttled(self, conn: Connection, scope: str, retry_after: float):
+        metrics.ws_throttled.inc(scope)
+        now = time.monotonic()
+        if now - conn.throttle_notice >= THROTTLE_NOTICE_INTERVAL:
+            conn.throttle_notice = now
+            notice = {"type": "throttled", "payload": {"scope": scope, "retryAfter": round(retry_after, 3)}}
+            conn.send(Frame(message=notice))
+
+    def _origin(self, canvas_id: int, sender: WebSocket | None) -> str | None:
+        conn = self.active_connections.get(canvas_id, {}).get(sender) if sender is not None else None
+        return conn.client if conn is not None else None
+
+    def _deliver(self, canvas_id: int, frame: Frame, sender: WebSocket | None = None, key=None):
+        stream = self.streams.get(canvas_id)
+        if stream is None:
+            return
+        frame = frame.stamped(stream.record([(self._origin(canvas_id, sender), frame)]))
+        room = self.active_connections.get(canvas_id)
+        if not room:
+            return
+        started = time.perf_counter()
+        for ws, conn in list(room.items()):
+            if ws is not sender:
+                conn.send(frame, key)
+        metrics.ws_fanout.observe(time.perf_counter() - started, "message")
+
+    def _on_remote(self, canvas_id: int, data: str):
+        frame = Frame.from_text(data)
+        if frame is None:
+            return
+        handler = self.ephemeral.get(frame.message.get("type"))
+        if handler is not None:
+            handler(canvas_id, frame)
+            return
+        for listener in self.listeners:
+            listener(canvas_id, frame)
+        self._deliver(canvas_id, frame)
+
+    async def broadcast(self, canvas_id: int, frame: Frame, sender: WebSocket | None = None, key=None):
+        # pending updates go out first so adds, deletes and strokes keep their order
+        await self.flush_updates(canvas_id)
+        self._deliver(canvas_id, frame, sender, key)
+        # the bus always carries JSON text
+        await self.pubsub.publish(canvas_id, frame.text)
+
+    async def broadcast_update(self, canvas_id: int, object_id: str, frame: Frame, sender: WebSocket | None = None):
+        if self.coalesce_interval <= 0:
+            await self.broadcast(canvas_id, frame, sender, key=("objectUpdate", object_id))
+            return
+        pending = self._pending_updates.get(canvas_id)
+        if pending is None:
+            pending = self._pending_updates[canvas_id] = {}
+            asyncio.get_running_loop().call_later(self.coalesce_interval, self._tick, canvas_id)
+        # re-insert so the batch follows the order of the latest changes
+        pending.pop(object_id, None)
+        pending[object_id] = (sender, self._origin(canvas_id, sender), frame)
+
+    def _tick(self, canvas_id: int):
+        task = asyncio.create_task(self.flush_updates(canvas_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush_updates(self, canvas_id: int):
+        pending = self._pending_updates.pop(canvas_id, None)
+        if not pending:
+            return
+        updates = list(pending.values())
+        stream = self.streams.get(canvas_id)
+        seq = stream.record([(origin, frame) for _, origin, frame in updates]) if stream is not None else 0
+        room = self.active_connections.get(canvas_id, {})
+        senders = {sender for sender, _, _ in updates}
+        started = time.perf_counter()
+        frames: dict[WebSocket | None, Frame | None] = {}
+        for ws, conn in list(room.items()):
+            # one batch per distinct sender: nobody gets their own updates back;
+            # each batch is then encoded at most once per wire format
+            excluded = ws if ws in senders else None
+            if excluded not in frames:
+                parts = [frame for sender, _, frame in updates if excluded is None or sender is not excluded]
+                frames[excluded] = Frame.batch(parts).stamped(seq) if parts else None
+            if frames[excluded] is not None:
+                conn.send(frames[excluded])
+        metrics.ws_fanout.observe(time.perf_counter() - started, "batch")
+        await self.pubsub.publish(canvas_id, Frame.batch([frame for _, _, frame in updates]).text)
+
+
+manager = ConnectionManager()
+
+
+def _room_connections() -> dict:
+    if metrics.METRICS_PER_CANVAS:
+        return {(str(canvas_id),): len(room) for canvas_id, room in manager.active_connections.items()}
+    return {("all",): sum(len(room) for room in manager.active_connections.values())}
+
+
+metrics.registry.gauge(
+    "ws_connections", "Open WebSocket connections per canvas", ("canvas",), collect=_room_connections
+)
+metrics.registry.gauge(
+    "ws_rooms", "Canvases with at least one open WebSocket", collect=lambda: {(): len(manager.active_connections)}
+)
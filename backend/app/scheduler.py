@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from . import metrics
+from .database import async_session
+from .models import SchedulerLease
+
+# each wait between runs is stretched or shrunk by up to this fraction, so
+# workers started together don't all hit the database at the same moment
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "0.1"))
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, name: str, interval: float, func, exclusive: bool = True):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        # exclusive jobs run on one worker per interval across the deployment,
+        # guarded by a lease row; the rest (local disk cleanup) run everywhere
+        self.exclusive = exclusive
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_run: float | None = None
+        self.last_duration: float | None = None
+        self.task: asyncio.Task | None = None
+
+
+class Scheduler:
+    def __init__(self, jitter: float = SCHEDULER_JITTER):
+        self.jitter = jitter
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.jobs: dict[str, Job] = {}
+
+    def add(self, name: str, interval: float, func, exclusive: bool = True):
+        self.jobs[name] = Job(name, interval, func, exclusive)
+
+    async def _acquire(self, job: Job) -> bool:
+        # The lease is held for the job's shortest possible gap between runs,
+        # so whichever worker wakes first after it lapses takes the next run.
+        # Taking it is one conditional UPDATE (or the very first INSERT); the
+        # job itself runs outside that transaction.
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=job.interval * (1 - self.jitter))
+        async with async_session() as db:
+            result = await db.execute(
+                update(SchedulerLease)
+                .where(SchedulerLease.name == job.name)
+                .where(SchedulerLease.expires_at < now)
+                .values(holder=self.holder, expires_at=until)
+            )
+            if result.rowcount:
+                await db.commit()
+                return True
+            db.add(SchedulerLease(name=job.name, holder=self.holder, expires_at=until))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # someone else holds it
+                return False
+            return True
+
+    async def run(self, job: Job) -> bool:
+        if job.exclusive and not await self._acquire(job):
+            job.skipped += 1
+            metrics.scheduler_runs.inc(job.name, "skipped")
+            return False
+        started = time.perf_counter()
+        try:
+            result = await job.func()
+        except Exception:
+            job.failures += 1
+            metrics.scheduler_runs.inc(job.name, "failed")
+            raise
+        finally:
+            job.last_run = time.time()
+            job.last_duration = time.perf_counter() - started
+        job.runs += 1
+        metrics.scheduler_runs.inc(job.name, "ok")
+        logger.info("Job %s finished in %.3fs: %s", job.name, job.last_duration, result)
+        return True
+
+    async def _loop(self, job: Job):
+        # the first run lands anywhere in the first interval
+        await asyncio.sleep(job.interval * random.random())
+        while True:
+            try:
+                await self.run(job)
+            except Exception:
+                logger.exception("Job %s failed", job.name)
+            await asyncio.sleep(job.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def start(self):
+        for job in self.jobs.values():
+            if job.task is None:
+                job.task = asyncio.create_task(self._loop(job))
+
+    async def stop(self):
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+                try:
+                    await job.task
+                except asyncio.CancelledError:
+                    pass
+                job.task = None
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "interval": job.interval,
+                "exclusive": job.exclusive,
+                "runs": job.runs,
+                "skipped": job.skipped,
+                "failures": job.failures,
+                "last_run": job.last_run,
+                "last_duration": job.last_duration,
+            }
+            for name, job in self.jobs.items()
+        }
+
+
+scheduler = Scheduler()
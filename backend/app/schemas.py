@@ -1,6 +1,17 @@
-from pydantic import BaseModel, EmailStr, ConfigDict
+import json
+from pydantic import BaseModel, EmailStr, ConfigDict, field_validator
 from datetime import datetime
-from typing import Dict, Optional, Literal
+from typing import Any, Dict, List, Optional, Literal
+
+
+def finite_json(value):
+    # the request body parser lets NaN and Infinity through, but neither the
+    # database's JSON column nor browsers' JSON.parse accept them
+    try:
+        json.dumps(value, allow_nan=False)
+    except ValueError:
+        raise ValueError("NaN and Infinity are not valid JSON numbers")
+    return value
 
 class UserCreate(BaseModel):
     email: EmailStr
@@ -28,11 +39,83 @@ class Canvas(CanvasBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class DashboardCanvas(BaseModel):
+    # every field is optional so ?fields= can trim the response
+    id: Optional[int] = None
+    name: Optional[str] = None
+    owner_id: Optional[int] = None
+    role: Optional[Literal["owner", "editor"]] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    invites: Optional[int] = None
+    members: Optional[int] = None
+
+class Dashboard(BaseModel):
+    items: List[DashboardCanvas]
+    next_cursor: Optional[str] = None
+
+class UploadCreate(BaseModel):
+    size: int
+    mime: str
+    # hex SHA-256 of the whole file, checked once the last chunk is in
+    sha256: str
+    filename: Optional[str] = None
+
+class UploadStatus(BaseModel):
+    id: Optional[str] = None
+    size: int
+    offset: int
+    chunk_size: int
+    complete: bool = False
+    # the blob URL to put in the canvas, once complete
+    url: Optional[str] = None
+
+class CanvasOmitted(BaseModel):
+    # what a bbox-scoped load left out
+    objects: int
+    strokes: int
+    bounds: Optional[List[float]] = None
+
+class PresenceMember(BaseModel):
+    email: str
+    connections: int
+
+class CanvasPresence(BaseModel):
+    # who has the canvas open right now, from memory rather than the database
+    members: List[PresenceMember]
+
 class CanvasData(BaseModel):
     content: Dict
+    version: Optional[int] = None
+    omitted: Optional[CanvasOmitted] = None
+    # "epoch:seq" to pass as `since` when opening the socket
+    session: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
+    _finite_content = field_validator("content")(finite_json)
+
+class CanvasOp(BaseModel):
+    type: Literal[
+        "objectAdd",
+        "objectUpdate",
+        "objectDelete",
+        "strokeAdd",
+        "remove_stroke",
+        "imageReplace",
+    ]
+    payload: Any = None
+
+    _finite_payload = field_validator("payload")(finite_json)
+
+class CanvasPatch(BaseModel):
+    base_version: int
+    ops: List[CanvasOp]
+
+class CanvasPatchResult(BaseModel):
+    version: int
+    applied: int
+
 class InvitationBase(BaseModel):
     invitee_email: str
 
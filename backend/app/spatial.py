@@ -0,0 +1,218 @@
+import math
+import os
+from collections import defaultdict
+
+SPATIAL_CELL_SIZE = float(os.getenv("SPATIAL_CELL_SIZE", "512"))
+# elements covering more cells than this live in one list checked on every query
+SPATIAL_MAX_CELLS = 256
+
+Box = tuple[float, float, float, float]
+
+
+def coerce_box(value) -> Box | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        raise ValueError("bbox needs four numbers")
+    x0, y0, x1, y1 = (float(v) for v in value)
+    if not all(math.isfinite(v) for v in (x0, y0, x1, y1)):
+        raise ValueError("bbox must be finite")
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def intersects(a: Box, b: Box) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def object_bounds(obj) -> Box | None:
+    if not isinstance(obj, dict):
+        return None
+    x, y, w, h = obj.get("x"), obj.get("y"), obj.get("width", 0), obj.get("height", 0)
+    if not all(_number(v) for v in (x, y, w, h)):
+        return None
+    x0, x1 = sorted((x, x + w))
+    y0, y1 = sorted((y, y + h))
+    pad = obj.get("strokeWidth", 0) / 2 if _number(obj.get("strokeWidth")) else 0
+    if obj.get("rotation"):
+        # any rotation stays inside the circle around the centre
+        pad += math.hypot(w, h) / 2 - min(abs(w), abs(h)) / 2
+    return x0 - pad, y0 - pad, x1 + pad, y1 + pad
+
+
+def stroke_bounds(stroke) -> Box | None:
+    if not isinstance(stroke, dict):
+        return None
+    xs, ys = [], []
+    path = stroke.get("path")
+    compact = stroke.get("cpath")
+    try:
+        if isinstance(path, list):
+            xs = [point["x"] for point in path]
+            ys = [point["y"] for point in path]
+        elif isinstance(compact, dict):
+            scale = compact.get("s") or 1
+            x = y = 0
+            deltas = compact.get("d") or []
+            for i in range(0, len(deltas) - 1, 2):
+                x += deltas[i]
+                y += deltas[i + 1]
+                xs.append(x / scale)
+                ys.append(y / scale)
+        if not xs:
+            return None
+        pad = stroke.get("size", 0) / 2 if _number(stroke.get("size")) else 0
+        return min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad
+    except (KeyError, TypeError):
+        return None
+
+
+def point_bounds(payload) -> Box | None:
+    if not isinstance(payload, dict) or not _number(payload.get("x")) or not _number(payload.get("y")):
+        return None
+    pad = payload.get("size", 0) / 2 if _number(payload.get("size")) else 0
+    return payload["x"] - pad, payload["y"] - pad, payload["x"] + pad, payload["y"] + pad
+
+
+def message_bounds(message: dict) -> list[Box] | None:
+    # where a message's new state lands; None when that can't be told
+    kind, payload = message.get("type"), message.get("payload")
+    if kind == "batch" and isinstance(payload, list):
+        boxes = []
+        for part in payload:
+            part_boxes = message_bounds(part) if isinstance(part, dict) else None
+            if part_boxes is None:
+                return None
+            boxes.extend(part_boxes)
+        return boxes
+    if kind in ("objectAdd", "objectUpdate"):
+        box = object_bounds(payload)
+    elif kind == "strokeAdd":
+        box = stroke_bounds(payload)
+    elif kind == "draw":
+        box = point_bounds(payload)
+    else:
+        return None
+    return [box] if box is not None else None
+
+
+def _union(a: Box | None, b: Box) -> Box:
+    if a is None:
+        return b
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+class GridIndex:
+    # uniform grid over element bounding boxes; keys are ("o", object key) or
+    # ("s", stroke key) and results come back in insertion (draw) order
+    def __init__(self, cell_size: float = SPATIAL_CELL_SIZE):
+        self.cell_size = cell_size
+        self.items: dict[tuple, tuple[int, Box | None, object]] = {}
+        self.cells: defaultdict[tuple[int, int], set] = defaultdict(set)
+        self.large: set = set()
+        self.unbounded: set = set()
+        self.counts = {"o": 0, "s": 0}
+        # grows only, so it may overstate the board after deletions
+        self.extent: Box | None = None
+        self._seq = 0
+
+    def _cells(self, box: Box):
+        size = self.cell_size
+        cx0, cy0 = math.floor(box[0] / size), math.floor(box[1] / size)
+        cx1, cy1 = math.floor(box[2] / size), math.floor(box[3] / size)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > SPATIAL_MAX_CELLS:
+            return None
+        return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+
+    def add(self, key: tuple, element, box: Box | None, seq: int | None = None):
+        previous = self.discard(key)
+        if seq is None:
+            seq = previous[0] if previous is not None else self._next_seq()
+        self.items[key] = (seq, box, element)
+        self.counts[key[0]] += 1
+        if box is None:
+            self.unbounded.add(key)
+            return
+        self.extent = _union(self.extent, box)
+        cells = self._cells(box)
+        if cells is None:
+            self.large.add(key)
+            return
+        for cell in cells:
+            self.cells[cell].add(key)
+
+    def discard(self, key: tuple) -> tuple[int, Box | None, object] | None:
+        item = self.items.pop(key, None)
+        if item is None:
+            return None
+        self.counts[key[0]] -= 1
+        box = item[1]
+        if box is None:
+            self.unbounded.discard(key)
+            return item
+        cells = self._cells(box)
+        if cells is None:
+            self.large.discard(key)
+            return item
+        for cell in cells:
+            keys = self.cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.cells[cell]
+        return item
+
+    def bounds(self, key: tuple) -> Box | None:
+        item = self.items.get(key)
+        return item[1] if item is not None else None
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def query(self, box: Box) -> list[tuple[tuple, object]]:
+        found = set(self.unbounded)
+        cells = self._cells(box)
+        if cells is None or len(cells) > len(self.cells):
+            candidates = (key for keys in self.cells.values() for key in keys)
+        else:
+            candidates = (key for cell in cells for key in self.cells.get(cell, ()))
+        for key in candidates:
+            if key not in found and intersects(box, self.items[key][1]):
+                found.add(key)
+        for key in self.large:
+            if intersects(box, self.items[key][1]):
+                found.add(key)
+        ordered = sorted(found, key=lambda key: self.items[key][0])
+        return [(key, self.items[key][2]) for key in ordered]
+
+
+def omitted_summary(total_objects: int, total_strokes: int, objects: list, strokes: list, extent: Box | None) -> dict:
+    return {
+        "objects": total_objects - len(objects),
+        "strokes": total_strokes - len(strokes),
+        "bounds": list(extent) if extent is not None else None,
+    }
+
+
+def filter_content(content: dict | None, box: Box) -> tuple[dict, dict]:
+    # one linear pass, for canvases that aren't loaded into a live document
+    content = content or {}
+    objects, strokes = [], []
+    extent = None
+    all_objects = content.get("objects") or []
+    all_strokes = content.get("strokes") or []
+    for items, bounds_of, kept in ((all_objects, object_bounds, objects), (all_strokes, stroke_bounds, strokes)):
+        for element in items:
+            element_box = bounds_of(element)
+            if element_box is not None:
+                extent = _union(extent, element_box)
+            if element_box is None or intersects(box, element_box):
+                kept.append(element)
+    visible = {**content, "objects": objects, "strokes": strokes}
+    return visible, omitted_summary(len(all_objects), len(all_strokes), objects, strokes, extent)
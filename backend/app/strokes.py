@@ -0,0 +1,128 @@
+import os
+
+import numpy as np
+
+# max distance in canvas pixels a simplified path may stray from the drawn one; 0 disables
+STROKE_TOLERANCE = float(os.getenv("STROKE_SIMPLIFY_TOLERANCE", "0.5"))
+# stored coordinates are rounded to 1/STROKE_PRECISION of a pixel
+STROKE_PRECISION = int(os.getenv("STROKE_PRECISION", "10"))
+
+# compact strokes carry {"s": scale, "d": [x0, y0, dx1, dy1, ...]} here instead of "path"
+COMPACT_KEY = "cpath"
+
+
+def _rdp_mask(points: np.ndarray, starts: np.ndarray, ends: np.ndarray, tolerance: float) -> np.ndarray:
+    # Ramer-Douglas-Peucker over many polylines at once, one level of the
+    # recursion at a time: every open segment of every path is measured in a
+    # single vectorized pass, so the Python loop runs ~log(points) times
+    keep = np.zeros(len(points), dtype=bool)
+    keep[starts] = True
+    keep[ends] = True
+    while len(starts):
+        inner_counts = ends - starts - 1
+        open_segments = inner_counts > 0
+        starts, ends, inner_counts = starts[open_segments], ends[open_segments], inner_counts[open_segments]
+        if not len(starts):
+            break
+        segment = np.repeat(np.arange(len(starts)), inner_counts)
+        offsets = np.cumsum(inner_counts) - inner_counts
+        inner = starts[segment] + 1 + (np.arange(len(segment)) - offsets[segment])
+
+        a = points[starts][segment]
+        ab = points[ends][segment] - a
+        ap = points[inner] - a
+        length = np.hypot(ab[:, 0], ab[:, 1])
+        cross = np.abs(ab[:, 0] * ap[:, 1] - ab[:, 1] * ap[:, 0])
+        # perpendicular distance to the chord, or to its start if it has no length
+        distance = np.where(length > 0, cross / np.where(length > 0, length, 1), np.hypot(ap[:, 0], ap[:, 1]))
+
+        segment_max = np.maximum.reduceat(distance, offsets)[segment]
+        hits = np.flatnonzero((distance == segment_max) & (segment_max > tolerance))
+        if not len(hits):
+            break
+        split_segments, first = np.unique(segment[hits], return_index=True)
+        split = inner[hits[first]]
+        keep[split] = True
+        starts = np.concatenate([starts[split_segments], split])
+        ends = np.concatenate([split, ends[split_segments]])
+    return keep
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    return points[_rdp_mask(points, np.array([0]), np.array([len(points) - 1]), tolerance)]
+
+
+def _points(path) -> np.ndarray | None:
+    try:
+        points = np.array([(point["x"], point["y"]) for point in path], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if points.ndim != 2 or points.shape[1] != 2 or not np.isfinite(points).all():
+        return None
+    return points
+
+
+def _compact(stroke: dict, points: np.ndarray, precision: int) -> dict:
+    quantized = np.rint(points * precision).astype(np.int64)
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    compact = {key: value for key, value in stroke.items() if key != "path"}
+    compact[COMPACT_KEY] = {"s": precision, "d": deltas.ravel().tolist()}
+    return compact
+
+
+def compact_strokes(strokes: list, tolerance: float = STROKE_TOLERANCE, precision: int = STROKE_PRECISION) -> list:
+    # strokes that are already compact, or not a list of {x, y}, come back as is
+    result = list(strokes)
+    parsed = []
+    for index, stroke in enumerate(strokes):
+        if isinstance(stroke, dict) and isinstance(stroke.get("path"), list) and stroke["path"]:
+            points = _points(stroke["path"])
+            if points is not None:
+                parsed.append((index, points))
+    if not parsed:
+        return result
+
+    sizes = np.array([len(points) for _, points in parsed])
+    ends = np.cumsum(sizes) - 1
+    starts = ends - sizes + 1
+    points = np.concatenate([points for _, points in parsed])
+    keep = _rdp_mask(points, starts, ends, tolerance) if tolerance > 0 else np.ones(len(points), dtype=bool)
+    for (index, _), start, end in zip(parsed, starts, ends):
+        stroke_points = points[start:end + 1][keep[start:end + 1]]
+        result[index] = _compact(strokes[index], stroke_points, precision)
+    return result
+
+
+def compact_stroke(stroke, tolerance: float = STROKE_TOLERANCE, precision: int = STROKE_PRECISION):
+    return compact_strokes([stroke], tolerance, precision)[0]
+
+
+def expand_stroke(stroke):
+    compact = stroke.get(COMPACT_KEY) if isinstance(stroke, dict) else None
+    if not isinstance(compact, dict):
+        return stroke
+    deltas = np.asarray(compact.get("d") or [], dtype=np.int64)
+    points = np.cumsum(deltas[: len(deltas) // 2 * 2].reshape(-1, 2), axis=0) / (compact.get("s") or 1)
+    expanded = {key: value for key, value in stroke.items() if key != COMPACT_KEY}
+    expanded["path"] = [{"x": x, "y": y} for x, y in points.tolist()]
+    return expanded
+
+
+def _map_strokes(content, fn):
+    if not isinstance(content, dict) or not isinstance(content.get("strokes"), list):
+        return content
+    strokes = fn(content["strokes"])
+    if all(new is old for new, old in zip(strokes, content["strokes"])):
+        return content
+    return {**content, "strokes": strokes}
+
+
+def compact_content(content):
+    # strokes that are already compact come back as the same objects
+    return _map_strokes(content, compact_strokes)
+
+
+def expand_content(content):
+    return _map_strokes(content, lambda strokes: [expand_stroke(stroke) for stroke in strokes])
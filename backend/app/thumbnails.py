@@ -0,0 +1,257 @@
+import asyncio
+import base64
+import binascii
+import glob
+import io
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .blobs import DATA_URL_RE, blob_digest, blob_store
+from .strokes import expand_stroke
+
+THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", "data/thumbnails")
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "320"))
+THUMBNAIL_POOL_SIZE = int(os.getenv("THUMBNAIL_POOL_SIZE", str(min(2, os.cpu_count() or 1))))
+
+# the drawing surface in the canvas page is a fixed 800x600
+CANVAS_WIDTH, CANVAS_HEIGHT = 800, 600
+BACKGROUND = "white"
+HIGHLIGHT_ALPHA = 96
+
+logger = logging.getLogger(__name__)
+
+
+def _image_source(value):
+    # only local sources: blobs by path, inline data URLs as is; never fetch URLs
+    digest = blob_digest(value)
+    if digest:
+        return blob_store.path(digest) if blob_store.exists(digest) else None
+    if isinstance(value, str) and DATA_URL_RE.match(value):
+        return value
+    return None
+
+
+def render_input(content: dict | None) -> dict:
+    # only what the renderer needs crosses into the worker process
+    content = content or {}
+    objects = []
+    for obj in content.get("objects") or []:
+        if not isinstance(obj, dict):
+            continue
+        if obj.get("type") == "image":
+            obj = {**obj, "src": _image_source(obj.get("src"))}
+        objects.append(obj)
+    return {
+        "image": _image_source(content.get("image")),
+        "objects": objects,
+        "strokes": [s for s in content.get("strokes") or [] if isinstance(s, dict)],
+    }
+
+
+def _open_image(source, target: tuple[int, int]):
+    from PIL import Image
+
+    if not source:
+        return None
+    try:
+        if source.startswith("data:"):
+            data = base64.b64decode(source[DATA_URL_RE.match(source).end():])
+            image = Image.open(io.BytesIO(data))
+        else:
+            image = Image.open(source)
+        # let JPEG decode at a reduced scale instead of full size
+        image.draft("RGB", target)
+        return image.convert("RGBA")
+    except (OSError, ValueError, binascii.Error, Image.DecompressionBombError):
+        return None
+
+
+def _color(value, alpha: int = 255):
+    from PIL import ImageColor
+
+    try:
+        return ImageColor.getrgb(value)[:3] + (alpha,)
+    except (ValueError, TypeError, AttributeError):
+        return (0, 0, 0, alpha)
+
+
+def _number(value, default=0.0) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else default
+
+
+def render(content: dict, width: int, fmt: str) -> bytes:
+    # runs in a worker process; draws straight at thumbnail scale
+    from PIL import Image, ImageDraw
+
+    height = round(width * CANVAS_HEIGHT / CANVAS_WIDTH)
+    scale = width / CANVAS_WIDTH
+    canvas = Image.new("RGBA", (width, height), BACKGROUND)
+
+    background = _open_image(content["image"], (width, height))
+    if background is not None:
+        size = (max(1, round(background.width * scale)), max(1, round(background.height * scale)))
+        canvas.alpha_composite(background.resize(size, Image.Resampling.BILINEAR))
+
+    draw = ImageDraw.Draw(canvas, "RGBA")
+    # strokes are painted onto the canvas bitmap, objects sit on top of it
+    for stroke in content["strokes"]:
+        stroke = expand_stroke(stroke)
+        try:
+            points = [(p["x"] * scale, p["y"] * scale) for p in stroke.get("path") or []]
+        except (KeyError, TypeError):
+            continue
+        if not points:
+            continue
+        mode = stroke.get("mode")
+        if mode == "erase":
+            color = _color(BACKGROUND)
+        else:
+            color = _color(stroke.get("color"), HIGHLIGHT_ALPHA if mode == "highlight" else 255)
+        line_width = max(1, round(_number(stroke.get("size"), 1) * scale))
+        if len(points) == 1:
+            points = points * 2
+        draw.line(points, fill=color, width=line_width, joint="curve")
+
+    for obj in content["objects"]:
+        x, y = _number(obj.get("x")) * scale, _number(obj.get("y")) * scale
+        w, h = _number(obj.get("width")) * scale, _number(obj.get("height")) * scale
+        if w <= 0 or h <= 0:
+            continue
+        box = (x, y, x + w, y + h)
+        kind = obj.get("type")
+        outline = max(1, round(_number(obj.get("strokeWidth"), 1) * scale))
+        if kind == "rectangle":
+            draw.rectangle(box, outline=_color(obj.get("color")), width=outline)
+        elif kind == "circle":
+            draw.ellipse(box, outline=_color(obj.get("color")), width=outline)
+        elif kind == "text":
+            draw.text((x, y), str(obj.get("text") or "")[:200], fill=_color(obj.get("color")))
+        elif kind == "image":
+            image = _open_image(obj.get("src"), (round(w), round(h)))
+            if image is not None:
+                image = image.resize((max(1, round(w)), max(1, round(h))), Image.Resampling.BILINEAR)
+                canvas.alpha_composite(image, (round(x), round(y)))
+            else:
+                draw.rectangle(box, fill=(230, 230, 230, 255))
+        else:
+            # audio, location and anything new: a placeholder card
+            draw.rectangle(box, fill=(240, 240, 240, 255), outline=(200, 200, 200, 255))
+
+    out = io.BytesIO()
+    if fmt == "webp":
+        canvas.convert("RGB").save(out, "WEBP", quality=80, method=4)
+    else:
+        canvas.convert("RGB").save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def _render_to_file(content: dict, width: int, fmt: str, path: str) -> str:
+    data = render(content, width, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return path
+
+
+def _webp_supported() -> bool:
+    try:
+        from PIL import features
+    except ImportError:
+        return False
+    return bool(features.check("webp"))
+
+
+class ThumbnailRenderer:
+    def __init__(self, root: str = THUMBNAIL_DIR, width: int = THUMBNAIL_WIDTH, workers: int = THUMBNAIL_POOL_SIZE):
+        self.root = root
+        self.width = width
+        self.workers = workers
+        self.format = "webp" if _webp_supported() else "png"
+        self.media_type = f"image/{self.format}"
+        self.rendered = 0
+        self.hits = 0
+        self.failures = 0
+        self._executor: ProcessPoolExecutor | None = None
+        # (canvas_id, revision) -> render in progress, so a burst of dashboard
+        # loads renders each board once
+        self._inflight: dict[tuple[int, str], asyncio.Future] = {}
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def path(self, canvas_id: int, revision: str) -> str:
+        return os.path.join(self.root, f"{canvas_id}-{revision}.{self.format}")
+
+    def cached(self, canvas_id: int, revision: str) -> str | None:
+        path = self.path(canvas_id, revision)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        return None
+
+    async def render(self, canvas_id: int, revision: str, content: dict | None) -> str:
+        key = (canvas_id, revision)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            path = self.path(canvas_id, revision)
+            job = render_input(content)
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, _render_to_file, job, self.width, self.format, path
+            )
+            self.rendered += 1
+            await asyncio.to_thread(self._remove_stale, canvas_id, keep=path)
+            future.set_result(path)
+            return path
+        except BaseException as exc:
+            self.failures += 1
+            future.set_exception(exc)
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def _remove_stale(self, canvas_id: int, keep: str | None = None):
+        for path in glob.glob(os.path.join(glob.escape(self.root), f"{canvas_id}-v*.*")):
+            if path != keep:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    async def invalidate(self, canvas_id: int):
+        await asyncio.to_thread(self._remove_stale, canvas_id)
+
+    def stats(self) -> dict:
+        return {
+            "format": self.format,
+            "workers": self.workers,
+            "rendered": self.rendered,
+            "cache_hits": self.hits,
+            "failures": self.failures,
+            "in_flight": len(self._inflight),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+thumbnails = ThumbnailRenderer()
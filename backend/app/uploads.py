@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+from .blobs import BLOB_DIR, blob_store, content_matches, safe_mime
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(BLOB_DIR.rstrip("/")) or ".", "uploads"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_TTL = float(os.getenv("UPLOAD_TTL", "86400"))
+# exact types, or "audio/" for any audio type; never wider than what the blob
+# route can safely serve (see blobs.BLOB_MIME_TYPES)
+UPLOAD_MIME_TYPES = tuple(
+    t.strip() for t in os.getenv("UPLOAD_MIME_TYPES", "image/png,image/jpeg,image/gif,image/webp,audio/").split(",")
+    if t.strip()
+)
+# concurrent chunk writes / media downloads per process; beyond that callers
+# wait up to MEDIA_QUEUE_TIMEOUT for a slot, then get a 503
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "64"))
+MEDIA_QUEUE_TIMEOUT = float(os.getenv("MEDIA_QUEUE_TIMEOUT", "5"))
+
+# the request body is written in pieces of about this size, each in a thread
+WRITE_BUFFER = 1024 * 1024
+
+ID_RE = re.compile(r"^[0-9a-f]{32}$")
+CONTENT_RANGE_RE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+class UploadError(Exception):
+    def __init__(self, status: int, detail, offset: int | None = None):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.offset = offset
+
+
+class Busy(Exception):
+    pass
+
+
+class Slots:
+    # a semaphore that gives up after a while instead of queueing forever
+    def __init__(self, limit: int, timeout: float = MEDIA_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self._sem = asyncio.Semaphore(limit)
+        self.in_use = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Busy()
+        self.in_use += 1
+
+    def release(self):
+        self.in_use -= 1
+        self._sem.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_use": self.in_use, "rejected": self.rejected}
+
+
+def parse_content_range(value: str | None) -> tuple[int, int, int] | None:
+    # "bytes first-last/total", last inclusive; returns (start, end, total)
+    match = CONTENT_RANGE_RE.match(value or "")
+    if not match:
+        return None
+    first, last, total = (int(g) for g in match.groups())
+    if last < first or last >= total:
+        return None
+    return first, last + 1, total
+
+
+class UploadStore:
+    # Resumable uploads straight to disk. A session is a metadata file plus a
+    # part file; the part file's length is the offset to resume from, so a
+    # session survives a restart or a dropped connection. Chunks must arrive
+    # in order; once the last one lands the whole file is checked against the
+    # declared SHA-256 and moved into the blob store under that digest.
+    def __init__(self, root: str = UPLOAD_DIR):
+        self.root = root
+        self.writes = Slots(UPLOAD_CONCURRENCY)
+        self.downloads = Slots(DOWNLOAD_CONCURRENCY)
+        # sessions with a chunk in flight on this process
+        self._active: set[str] = set()
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.root, upload_id + ".json")
+
+    def _part_path(self, upload_id: str) -> str:
+        return os.path.join(self.root, upload_id + ".part")
+
+    def allowed_mime(self, mime: str) -> bool:
+        if not safe_mime(mime):
+            return False
+        return any(mime == t or (t == "audio/" and mime.startswith(t)) for t in UPLOAD_MIME_TYPES)
+
+    def _create(self, meta: dict):
+        os.makedirs(self.root, exist_ok=True)
+        open(self._part_path(meta["id"]), "wb").close()
+        tmp = self._meta_path(meta["id"]) + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, self._meta_path(meta["id"]))
+
+    async def create(self, user_id: int, size: int, mime: str, sha256: str, filename: str | None) -> dict:
+        meta = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "size": size,
+            "mime": mime,
+            "sha256": sha256,
+            "filename": filename,
+            "created": time.time(),
+        }
+        await asyncio.to_thread(self._create, meta)
+        return meta
+
+    def _load(self, upload_id: str) -> tuple[dict, int] | None:
+        if not ID_RE.match(upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as fh:
+                meta = json.load(fh)
+            return meta, os.path.getsize(self._part_path(upload_id))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    async def get(self, upload_id: str, user_id: int) -> tuple[dict, int] | None:
+        loaded = await asyncio.to_thread(self._load, upload_id)
+        if loaded is None or loaded[0]["user_id"] != user_id:
+            return None
+        return loaded
+
+    def _discard(self, upload_id: str):
+        for path in (self._meta_path(upload_id), self._part_path(upload_id)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def discard(self, upload_id: str):
+        await asyncio.to_thread(self._discard, upload_id)
+
+    async def write_chunk(self, upload_id: str, user_id: int, start: int, end: int, total: int, body,
+                          chunk_sha256: str | None = None) -> tuple[dict, int]:
+        # body is an async iterator of bytes, read as it arrives
+        if upload_id in self._active:
+            raise UploadError(409, "Another chunk for this upload is in progress")
+        loaded = await self.get(upload_id, user_id)
+        if loaded is None:
+            raise UploadError(404, "Upload not found")
+        meta, offset = loaded
+        if total != meta["size"]:
+            raise UploadError(400, f"Content-Range total must be {meta['size']}", offset)
+        if start != offset:
+            raise UploadError(409, f"Expected a chunk starting at byte {offset}", offset)
+        if end - start > UPLOAD_CHUNK_BYTES:
+            raise UploadError(413, f"Chunks are limited to {UPLOAD_CHUNK_BYTES} bytes", offset)
+
+        self._active.add(upload_id)
+        try:
+            written = await self._receive(upload_id, start, end, body, chunk_sha256)
+        finally:
+            self._active.discard(upload_id)
+        return meta, start + written
+
+    async def _receive(self, upload_id: str, start: int, end: int, body, chunk_sha256: str | None) -> int:
+        digest = hashlib.sha256() if chunk_sha256 else None
+        fh = await asyncio.to_thread(open, self._part_path(upload_id), "r+b")
+        written = 0
+        try:
+            await asyncio.to_thread(fh.seek, start)
+            pending: list[bytes] = []
+            buffered = 0
+            async for piece in body:
+                if written + buffered + len(piece) > end - start:
+                    raise UploadError(400, "Chunk is longer than its Content-Range", start)
+                pending.append(piece)
+                buffered += len(piece)
+                if buffered >= WRITE_BUFFER:
+                    data = b"".join(pending)
+                    await asyncio.to_thread(fh.write, data)
+                    if digest is not None:
+                        digest.update(data)
+                    written += buffered
+                    pending, buffered = [], 0
+            if pending:
+                data = b"".join(pending)
+                await asyncio.to_thread(fh.write, data)
+                if digest is not None:
+                    digest.update(data)
+                written += buffered
+            if written != end - start:
+                raise UploadError(400, "Chunk is shorter than its Content-Range", start)
+            if digest is not None and digest.hexdigest() != chunk_sha256:
+                raise UploadError(422, "Chunk checksum mismatch", start)
+        except UploadError:
+            # a bad chunk is dropped whole; a merely interrupted one is kept so
+            # the client can resume from wherever it got to
+            await asyncio.to_thread(fh.truncate, start)
+            raise
+        finally:
+            await asyncio.to_thread(fh.close)
+        return written
+
+    def _finish(self, meta: dict) -> bool:
+        path = self._part_path(meta["id"])
+        digest = hashlib.sha256()
+        with open(path, "rb") as fh:
+            head = fh.read(16)
+            digest.update(head)
+            while block := fh.read(WRITE_BUFFER):
+                digest.update(block)
+        if digest.hexdigest() != meta["sha256"]:
+            return False
+        if not content_matches(meta["mime"], head):
+            raise UploadError(415, f"The file is not {meta['mime']}; the upload was discarded")
+        target = blob_store.path(meta["sha256"])
+        if os.path.exists(target):
+            # fresh again, so the blob file sweep leaves it alone
+            os.utime(target)
+            return True
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError:
+            # another filesystem: copy next to the target first, so readers
+            # only ever see a missing file or a complete one
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as out, open(path, "rb") as src:
+                    shutil.copyfileobj(src, out, WRITE_BUFFER)
+                os.replace(tmp, target)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        return True
+
+    async def finish(self, meta: dict) -> bool:
+        # hashing a few hundred MB takes a while; it stays off the event loop
+        try:
+            return await asyncio.to_thread(self._finish, meta)
+        finally:
+            await self.discard(meta["id"])
+
+    def _expire(self) -> int:
+        cutoff = time.time() - UPLOAD_TTL
+        removed = 0
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            upload_id, _, ext = name.partition(".")
+            if ext != "json" or upload_id in self._active:
+                continue
+            try:
+                # the part file's mtime is the last time a chunk arrived
+                if os.path.getmtime(self._part_path(upload_id)) >= cutoff:
+                    continue
+            except FileNotFoundError:
+                pass
+            self._discard(upload_id)
+            removed += 1
+        return removed
+
+    async def expire(self) -> int:
+        return await asyncio.to_thread(self._expire)
+
+    def stats(self) -> dict:
+        return {"writes": self.writes.stats(), "downloads": self.downloads.stats(), "active": len(self._active)}
+
+
+uploads = UploadStore()
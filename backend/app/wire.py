@@ -0,0 +1,206 @@
+import json
+import math
+import struct
+
+import msgpack
+
+JSON_SUBPROTOCOL = "innoboard.json"
+MSGPACK_SUBPROTOCOL = "innoboard.msgpack"
+
+
+def _pack_path(path) -> bytes:
+    # [{x, y}, ...] -> little-endian float32 pairs, 8 bytes per point
+    flat = []
+    for point in path:
+        flat.append(point["x"])
+        flat.append(point["y"])
+    return struct.pack(f"<{len(flat)}f", *flat)
+
+
+def _unpack_path(data: bytes) -> list[dict]:
+    flat = struct.unpack(f"<{len(data) // 4}f", data)
+    return [{"x": round(flat[i], 3), "y": round(flat[i + 1], 3)} for i in range(0, len(flat) - 1, 2)]
+
+
+def to_binary_shape(message: dict) -> dict:
+    kind, payload = message.get("type"), message.get("payload")
+    if kind == "batch" and isinstance(payload, list):
+        return {**message, "payload": [to_binary_shape(part) for part in payload if isinstance(part, dict)]}
+    if kind == "strokeAdd" and isinstance(payload, dict) and isinstance(payload.get("path"), list):
+        try:
+            stroke = {key: value for key, value in payload.items() if key != "path"}
+            stroke["xy"] = _pack_path(payload["path"])
+            return {**message, "payload": stroke}
+        except (KeyError, TypeError, struct.error):
+            pass
+    return message
+
+
+def to_json_shape(message: dict) -> dict:
+    kind, payload = message.get("type"), message.get("payload")
+    if kind == "batch" and isinstance(payload, list):
+        return {**message, "payload": [to_json_shape(part) for part in payload if isinstance(part, dict)]}
+    if kind == "strokeAdd" and isinstance(payload, dict) and isinstance(payload.get("xy"), bytes):
+        stroke = {key: value for key, value in payload.items() if key != "xy"}
+        stroke["path"] = _unpack_path(payload["xy"])
+        return {**message, "payload": stroke}
+    return message
+
+
+def _array_header(size: int) -> bytes:
+    if size < 16:
+        return bytes([0x90 | size])
+    if size < 0x10000:
+        return b"\xdc" + struct.pack(">H", size)
+    return b"\xdd" + struct.pack(">I", size)
+
+
+def _reject_constant(name: str):
+    raise ValueError(f"{name} is not valid JSON")
+
+
+def _finite_float(text: str) -> float:
+    # 1e400 parses to inf just the same
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError(f"{text} is out of range")
+    return value
+
+
+class Frame:
+    # One relayed message, encoded at most once per wire format no matter how
+    # many sockets it goes to.
+    __slots__ = ("_text", "_binary", "_message", "bounds")
+
+    def __init__(self, text: str | None = None, binary: bytes | None = None, message: dict | None = None):
+        self._text = text
+        self._binary = binary
+        self._message = message
+        # boxes on the board this message touches, for viewport filtering;
+        # None sends it to everyone
+        self.bounds: list | None = None
+
+    @classmethod
+    def from_text(cls, text: str) -> "Frame | None":
+        try:
+            # no NaN/Infinity, as in from_binary: nothing downstream can store or parse them
+            message = json.loads(text, parse_constant=_reject_constant, parse_float=_finite_float)
+        except ValueError:
+            return None
+        return cls(text=text, message=message) if isinstance(message, dict) else None
+
+    @classmethod
+    def from_binary(cls, data: bytes) -> "Frame | None":
+        try:
+            message = msgpack.unpackb(data, raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            return None
+        if not isinstance(message, dict):
+            return None
+        message = to_json_shape(message)
+        # Everything relayed or stored must also have a JSON form; msgpack can
+        # carry bytes, ext types and NaN that JSON can't, and finding that out
+        # only when a JSON peer or a flush encodes it would poison the room.
+        try:
+            text = json.dumps(message, allow_nan=False)
+        except (TypeError, ValueError):
+            return None
+        return cls(text=text, binary=data, message=message)
+
+    @classmethod
+    def batch(cls, frames: list["Frame"]) -> "Frame":
+        if len(frames) == 1:
+            return frames[0]
+        return _BatchFrame(frames)
+
+    def stamped(self, seq: int) -> "Frame":
+        return _StampedFrame(self, seq)
+
+    @property
+    def message(self) -> dict:
+        return self._message
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self._message)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(to_binary_shape(self._message), use_bin_type=True)
+        return self._binary
+
+
+class _BatchFrame(Frame):
+    __slots__ = ("_parts",)
+
+    def __init__(self, parts: list[Frame]):
+        super().__init__()
+        self._parts = parts
+        if all(part.bounds is not None for part in parts):
+            self.bounds = [box for part in parts for box in part.bounds]
+
+    @property
+    def message(self) -> dict:
+        if self._message is None:
+            self._message = {"type": "batch", "payload": [part.message for part in self._parts]}
+        return self._message
+
+    # the parts are already encoded, so splice them instead of re-encoding
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = '{"type": "batch", "payload": [' + ", ".join(part.text for part in self._parts) + "]}"
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            head = b"\x82" + msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("payload")
+            self._binary = head + _array_header(len(self._parts)) + b"".join(part.binary for part in self._parts)
+        return self._binary
+
+
+class _StampedFrame(Frame):
+    # a frame plus the room sequence number it was relayed under; appended as
+    # a trailing "seq" key so the original encoding is reused
+    __slots__ = ("_inner", "seq")
+
+    def __init__(self, inner: Frame, seq: int):
+        super().__init__()
+        self._inner = inner
+        self.seq = seq
+        self.bounds = inner.bounds
+
+    @property
+    def message(self) -> dict:
+        if self._message is None:
+            self._message = {**self._inner.message, "seq": self.seq}
+        return self._message
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            body = self._inner.text.rstrip()
+            if self._inner.message and body.endswith("}"):
+                self._text = f'{body[:-1]}, "seq": {self.seq}}}'
+            else:
+                self._text = json.dumps(self.message)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            data = self._inner.binary
+            tail = msgpack.packb("seq") + msgpack.packb(self.seq)
+            if 0x80 <= data[0] < 0x8F:
+                self._binary = bytes([data[0] + 1]) + data[1:] + tail
+            elif data[0] == 0xDE and struct.unpack(">H", data[1:3])[0] < 0xFFFF:
+                size = struct.unpack(">H", data[1:3])[0] + 1
+                self._binary = b"\xde" + struct.pack(">H", size) + data[3:] + tail
+            else:
+                self._binary = msgpack.packb(to_binary_shape(self.message), use_bin_type=True)
+        return self._binary
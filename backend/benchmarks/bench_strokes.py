@@ -0,0 +1,70 @@
+"""Size and time of stroke compaction on synthetic canvases.
+
+Run from backend/:  python -m benchmarks.bench_strokes --strokes 2000 --points 400
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from app.strokes import compact_content, expand_content
+
+
+def synthetic_content(strokes: int, points: int, seed: int) -> dict:
+    # smooth pen-like curves sampled at pointer-event density, with jitter
+    rng = np.random.default_rng(seed)
+    result = []
+    for i in range(strokes):
+        start = rng.uniform(0, 2000, size=2)
+        heading = np.cumsum(rng.normal(0, 0.08, size=points)) + rng.uniform(0, 2 * np.pi)
+        step = rng.uniform(0.5, 3.0)
+        xy = start + np.cumsum(np.stack([np.cos(heading), np.sin(heading)], axis=1) * step, axis=0)
+        xy += rng.normal(0, 0.15, size=xy.shape)
+        path = [{"x": round(x, 2), "y": round(y, 2)} for x, y in xy.tolist()]
+        result.append({"id": f"s{i}", "mode": "draw", "color": "#000000", "size": 2, "path": path})
+    return {"objects": [], "strokes": result}
+
+
+def timed(fn, *args, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        value = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return value, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strokes", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    content = synthetic_content(args.strokes, args.points, args.seed)
+    legacy_json, legacy_dump = timed(json.dumps, content, repeat=args.repeat)
+    compact, compact_time = timed(compact_content, content, repeat=args.repeat)
+    compact_json, compact_dump = timed(json.dumps, compact, repeat=args.repeat)
+    expanded, expand_time = timed(expand_content, compact, repeat=args.repeat)
+
+    points_in = sum(len(s["path"]) for s in content["strokes"])
+    points_out = sum(len(s["path"]) for s in expanded["strokes"])
+    print(json.dumps({
+        "strokes": args.strokes,
+        "points": points_in,
+        "points_kept": points_out,
+        "legacy_bytes": len(legacy_json),
+        "compact_bytes": len(compact_json),
+        "size_ratio": round(len(compact_json) / len(legacy_json), 4),
+        "compact_ms": round(compact_time * 1000, 2),
+        "expand_ms": round(expand_time * 1000, 2),
+        "legacy_dumps_ms": round(legacy_dump * 1000, 2),
+        "compact_dumps_ms": round(compact_dump * 1000, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Load test for the REST and WebSocket paths against a throwaway SQLite database.
+
+Starts the backend in a uvicorn subprocess, then drives it from this process:
+N rooms x M WebSocket clients sending objectUpdate/strokeAdd traffic, plus
+REST saves and loads of boards of several sizes and an authenticated no-op
+route. Prints one JSON document with throughput and p50/p95/p99 latencies.
+
+Run from backend/:
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.loadtest --rooms 10 --clients 5 --duration 10 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+import websockets
+
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3),
+        "p50_ms": round(rank(50), 3),
+        "p95_ms": round(rank(95), 3),
+        "p99_ms": round(rank(99), 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir: str, port: int, extra_env: dict) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}",
+        "SECRET_KEY": "benchmark",
+        "SQL_ECHO": "false",
+        "BLOB_DIR": os.path.join(workdir, "blobs"),
+        "THUMBNAIL_DIR": os.path.join(workdir, "thumbnails"),
+        "PUBSUB_URL": "memory://",
+        **extra_env,
+    }
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-m", "app.migrate"], cwd=backend, env=env, check=True, capture_output=True)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=backend,
+        env=env,
+    )
+
+
+async def wait_ready(base: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/readyz")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def stroke(points: int, rng: random.Random) -> dict:
+    x, y = rng.uniform(0, 800), rng.uniform(0, 600)
+    path = []
+    for _ in range(points):
+        x += rng.uniform(-4, 4)
+        y += rng.uniform(-4, 4)
+        path.append({"x": round(x, 2), "y": round(y, 2)})
+    return {"id": str(uuid.uuid4()), "mode": "draw", "color": "#000000", "size": 3, "path": path, "createdAt": 0}
+
+
+def shape(index: int, rng: random.Random) -> dict:
+    return {
+        "id": f"obj-{index}", "type": "rectangle", "x": rng.uniform(0, 700), "y": rng.uniform(0, 500),
+        "width": 100, "height": 80, "color": "#ff0000", "strokeWidth": 2, "rotation": 0,
+    }
+
+
+def board(strokes: int, objects: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    return {
+        "objects": [shape(i, rng) for i in range(objects)],
+        "strokes": [stroke(60, rng) for _ in range(strokes)],
+    }
+
+
+async def signup(client: httpx.AsyncClient, email: str) -> str:
+    response = await client.post("/signup", json={"email": email, "password": "benchmark"})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def timed_requests(count: int, concurrency: int, call) -> tuple[list[float], int, float]:
+    # runs `call` count times with bounded concurrency; returns latencies, failures, wall time
+    latencies: list[float] = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await call()
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append((time.perf_counter() - started) * 1000)
+            else:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(count)))
+    return latencies, failures, time.perf_counter() - started
+
+
+def rest_result(latencies: list[float], failures: int, elapsed: float) -> dict:
+    return {
+        **percentiles(latencies),
+        "failures": failures,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+async def bench_rest(base: str, token: str, sizes: list[int], requests: int, concurrency: int) -> dict:
+    headers = {"Authorization": f"Bearer {token}"}
+    results = {}
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base, headers=headers, limits=limits, timeout=60) as client:
+        latencies, failures, elapsed = await timed_requests(
+            requests, concurrency, lambda: client.get("/canvases")
+        )
+        results["auth_list_canvases"] = rest_result(latencies, failures, elapsed)
+
+        for size in sizes:
+            canvas = (await client.post("/canvases", json={"name": f"rest-{size}"})).json()
+            url = f"/canvases/{canvas['id']}/data"
+            body = json.dumps({"content": board(size, max(1, size // 10), size)})
+            save, save_failures, save_elapsed = await timed_requests(
+                requests, concurrency,
+                lambda: client.post(url, content=body, headers={"Content-Type": "application/json"}),
+            )
+            load, load_failures, load_elapsed = await timed_requests(
+                requests, concurrency, lambda: client.get(url, headers={"Accept-Encoding": "gzip"})
+            )
+            results[f"board_{size}_strokes"] = {
+                "request_bytes": len(body),
+                "save": rest_result(save, save_failures, save_elapsed),
+                "load": rest_result(load, load_failures, load_elapsed),
+            }
+    return results
+
+
+class RoomClient:
+    def __init__(self, room: int, index: int, url: str, stats: dict):
+        self.room = room
+        self.index = index
+        self.url = url
+        self.stats = stats
+        self.ws = None
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.ws = await websockets.connect(self.url, max_size=None)
+        self.stats["connect"].append((time.perf_counter() - started) * 1000)
+
+    def _record(self, message: dict):
+        if message.get("type") == "batch":
+            for part in message.get("payload") or []:
+                self._record(part)
+            return
+        payload = message.get("payload")
+        if not isinstance(payload, dict) or "sentAt" not in payload:
+            return
+        latency = (time.perf_counter() - payload["sentAt"]) * 1000
+        self.stats["latency"].setdefault(message["type"], []).append(latency)
+        self.stats["received"] += 1
+
+    async def receive(self):
+        try:
+            async for raw in self.ws:
+                self._record(json.loads(raw))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_loop(self, until: float, rate: float, stroke_ratio: float, objects: int, rng: random.Random):
+        interval = 1 / rate
+        next_send = time.perf_counter() + rng.uniform(0, interval)
+        while next_send < until:
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            if rng.random() < stroke_ratio:
+                payload = stroke(20, rng)
+                kind = "strokeAdd"
+            else:
+                payload = shape(rng.randrange(objects), rng)
+                kind = "objectUpdate"
+            payload["sentAt"] = time.perf_counter()
+            await self.ws.send(json.dumps({"type": kind, "payload": payload}))
+            self.stats["sent"][kind] = self.stats["sent"].get(kind, 0) + 1
+            next_send += interval
+
+
+async def bench_ws(base: str, ws_base: str, rooms: int, clients: int, duration: float, rate: float,
+                   stroke_ratio: float, objects: int, seed: int) -> dict:
+    stats = {"connect": [], "latency": {}, "sent": {}, "received": 0}
+    rng = random.Random(seed)
+    room_clients: list[RoomClient] = []
+    async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+        for room in range(rooms):
+            token = await signup(client, f"room{room}-{uuid.uuid4().hex[:8]}@example.com")
+            headers = {"Authorization": f"Bearer {token}"}
+            canvas = (await client.post("/canvases", json={"name": f"room-{room}"}, headers=headers)).json()
+            content = board(0, objects, seed + room)
+            await client.post(f"/canvases/{canvas['id']}/data", json={"content": content}, headers=headers)
+            url = f"{ws_base}/ws/canvas/{canvas['id']}?token={token}"
+            room_clients.extend(RoomClient(room, i, url, stats) for i in range(clients))
+
+    await asyncio.gather(*(c.connect() for c in room_clients))
+    receivers = [asyncio.create_task(c.receive()) for c in room_clients]
+    started = time.perf_counter()
+    until = started + duration
+    await asyncio.gather(*(
+        c.send_loop(until, rate, stroke_ratio, objects, random.Random(rng.random())) for c in room_clients
+    ))
+    # let in-flight and coalesced frames arrive
+    await asyncio.sleep(0.5)
+    elapsed = time.perf_counter() - started
+    for c in room_clients:
+        await c.ws.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    sent = sum(stats["sent"].values())
+    return {
+        "rooms": rooms,
+        "clients_per_room": clients,
+        "duration_s": round(elapsed, 3),
+        "sent": stats["sent"],
+        "delivered": stats["received"],
+        # every message goes to the other clients in its room
+        "expected_deliveries": sent * (clients - 1),
+        "sent_per_s": round(sent / elapsed, 2),
+        "delivered_per_s": round(stats["received"] / elapsed, 2),
+        "connect": percentiles(stats["connect"]),
+        "latency": {kind: percentiles(samples) for kind, samples in stats["latency"].items()},
+    }
+
+
+async def run(args) -> dict:
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(workdir, port, dict(kv.split("=", 1) for kv in args.env))
+        try:
+            await wait_ready(base)
+            async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+                token = await signup(client, f"rest-{uuid.uuid4().hex[:8]}@example.com")
+            rest = await bench_rest(base, token, args.board_sizes, args.requests, args.concurrency)
+            ws = await bench_ws(
+                base, f"ws://127.0.0.1:{port}", args.rooms, args.clients, args.duration, args.rate,
+                args.stroke_ratio, args.objects, args.seed,
+            )
+            async with httpx.AsyncClient(base_url=base) as client:
+                server_stats = (await client.get("/stats")).json()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "rest": rest,
+        "websocket": ws,
+        "server_stats": server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--clients", type=int, default=4, help="WebSocket clients per room")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of WebSocket traffic")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second per client")
+    parser.add_argument("--stroke-ratio", type=float, default=0.2, help="share of strokeAdd vs objectUpdate")
+    parser.add_argument("--objects", type=int, default=50, help="objects per room that updates move")
+    parser.add_argument("--board-sizes", type=lambda v: [int(x) for x in v.split(",")], default=[10, 1000, 5000],
+                        help="strokes per board for the REST save/load runs")
+    parser.add_argument("--requests", type=int, default=50, help="REST requests per measurement")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the server, e.g. --env WS_COALESCE_MS=0")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
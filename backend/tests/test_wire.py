@@ -0,0 +1,36 @@
+import json
+
+import msgpack
+
+from app.wire import Frame
+
+
+def pack(message: dict) -> bytes:
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def test_binary_stroke_is_converted_to_json_shape():
+    stroke = {"type": "strokeAdd", "payload": {"id": "s1", "xy": b"\x00\x00\x80\x3f\x00\x00\x00\x40"}}
+    frame = Frame.from_binary(pack(stroke))
+    assert frame is not None
+    assert frame.message["payload"]["path"] == [{"x": 1.0, "y": 2.0}]
+    assert json.loads(frame.text) == frame.message
+
+
+def test_binary_frame_with_bytes_outside_stroke_path_is_rejected():
+    assert Frame.from_binary(pack({"type": "objectAdd", "payload": {"id": "o1", "src": b"\x00\x01"}})) is None
+    assert Frame.from_binary(pack({"type": "strokeAdd", "payload": {"id": "s1", "color": b"red", "xy": b""}})) is None
+    nested = {"type": "batch", "payload": [{"type": "objectUpdate", "payload": {"id": "o1", "x": b"1"}}]}
+    assert Frame.from_binary(pack(nested)) is None
+
+
+def test_binary_frame_with_ext_or_nan_is_rejected():
+    assert Frame.from_binary(pack({"type": "draw", "payload": {"x": msgpack.ExtType(1, b"x")}})) is None
+    assert Frame.from_binary(pack({"type": "draw", "payload": {"x": float("nan")}})) is None
+
+
+def test_text_frame_with_nan_or_infinity_is_rejected():
+    assert Frame.from_text('{"type": "objectUpdate", "payload": {"id": "o1", "x": NaN}}') is None
+    assert Frame.from_text('{"type": "draw", "payload": {"x": -Infinity}}') is None
+    assert Frame.from_text('{"type": "draw", "payload": {"x": 1e400}}') is None
+    assert Frame.from_text('{"type": "draw", "payload": {"x": 1.5}}').message["payload"]["x"] == 1.5
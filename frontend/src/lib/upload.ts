@@ -0,0 +1,63 @@
+// src/lib/upload.ts
+// Sends a file to the backend in chunks and returns the blob URL to put in the
+// canvas. A failed chunk is retried from wherever the server says it got to.
+
+// the server refused the file itself; retrying won't help
+class UploadRejected extends Error {}
+
+const toHex = (buf: ArrayBuffer) =>
+  Array.from(new Uint8Array(buf), (b) => b.toString(16).padStart(2, "0")).join("");
+
+export async function uploadMedia(
+  file: File,
+  token: string | null,
+  onProgress?: (sent: number, total: number) => void
+): Promise<string> {
+  const auth = { Authorization: `Bearer ${token}` };
+  const sha256 = toHex(await crypto.subtle.digest("SHA-256", await file.arrayBuffer()));
+
+  let resp = await fetch("/api/uploads", {
+    method: "POST",
+    headers: { ...auth, "Content-Type": "application/json" },
+    body: JSON.stringify({
+      size: file.size,
+      mime: file.type || "application/octet-stream",
+      sha256,
+      filename: file.name,
+    }),
+  });
+  let status = await resp.json();
+  if (!resp.ok) throw new UploadRejected(status.detail || "Upload failed");
+
+  let failures = 0;
+  while (!status.complete) {
+    const start: number = status.offset;
+    const end = Math.min(start + status.chunk_size, file.size);
+    try {
+      resp = await fetch(`/api/uploads/${status.id}`, {
+        method: "PUT",
+        headers: { ...auth, "Content-Range": `bytes ${start}-${end - 1}/${file.size}` },
+        body: file.slice(start, end),
+      });
+      if (resp.ok) {
+        status = await resp.json();
+        failures = 0;
+        onProgress?.(status.offset, file.size);
+        continue;
+      }
+      if (resp.status === 422 || resp.status === 413 || resp.status === 415) {
+        throw new UploadRejected((await resp.json()).detail || "Upload rejected");
+      }
+    } catch (err) {
+      // anything else (network error, 409, 503) is worth another try
+      if (err instanceof UploadRejected) throw err;
+    }
+    if (++failures > 5) throw new Error("Upload failed");
+    await new Promise((r) => setTimeout(r, 500 * 2 ** failures));
+    // ask where to pick up; part of the chunk may have made it
+    resp = await fetch(`/api/uploads/${status.id}`, { headers: auth });
+    if (!resp.ok) throw new Error("Upload expired");
+    status = await resp.json();
+  }
+  return status.url;
+}
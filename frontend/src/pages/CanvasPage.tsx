@@ -9,6 +9,7 @@ import { CanvasObject, Mode, Stroke } from "@/types/canvas"
 import { OverlayObject } from "@/components/canvasPage/OverlayObject"
 import { LocationPicker } from "@/components/canvasPage/LocationPicker"
 import { createApiCall } from "@/lib/api"
+import { uploadMedia } from "@/lib/upload"
 
 import { Button } from "@/components/ui/button"
 import {
@@ -67,6 +68,13 @@ const CanvasPage: React.FC = () => {
 
   const canvasRef = useRef<HTMLCanvasElement>(null)
   const wsRef = useRef<WebSocket>()
+  // identifies this tab across reconnects so the server leaves our own ops out of a replay
+  const clientIdRef = useRef(crypto.randomUUID())
+  // position in the room's op stream; sent back on reconnect to get only what was missed
+  const resumeRef = useRef<{ epoch: string; seq: number } | null>(null)
+  // other people's cursors, keyed per socket; ours is presenceKeyRef
+  const [peers, setPeers] = useState<Record<string, { user: string; state: { x: number; y: number } | null }>>({})
+  const presenceKeyRef = useRef<string | null>(null)
   const [canvasInfo, setCanvasInfo] = useState<{ name: string } | null>(null)
   const [objects, setObjects] = useState<CanvasObject[]>([])
   const [strokes, setStrokes] = useState<Stroke[]>([])
@@ -109,39 +117,119 @@ const CanvasPage: React.FC = () => {
       .catch(() => navigate("/dashboard"))
   }, [id, token, navigate])
 
+  function applyContent(content: any) {
+    setObjects(content.objects || [])
+    setStrokes(content.strokes || [])
+    if (content.image && canvasRef.current) {
+      const ctx = canvasRef.current.getContext("2d")!
+      const img = new Image()
+      img.onload = () => {
+        ctx.clearRect(0, 0, 800, 600)
+        ctx.drawImage(img, 0, 0)
+        replayStrokes(ctx, content.strokes || [])
+      }
+      img.src = content.image
+    } else if (canvasRef.current) {
+      const ctx = canvasRef.current.getContext("2d")!
+      ctx.clearRect(0, 0, 800, 600)
+      replayStrokes(ctx, content.strokes || [])
+    }
+  }
+
   useEffect(() => {
     if (!token || !id) return
+    let ws: WebSocket
+    let retry: ReturnType<typeof setTimeout> | undefined
+    let attempts = 0
+    let stopped = false
+    resumeRef.current = null
+
+    const open = () => {
+      const resume = resumeRef.current
+      const since = resume ? `&since=${resume.epoch}:${resume.seq}` : ""
+      ws = new WebSocket(
+        `ws://localhost:8000/ws/canvas/${id}?token=${token}&client=${clientIdRef.current}${since}`
+      )
+      ws.onopen = () => {
+        attempts = 0
+        wsRef.current = ws
+      }
+      ws.onmessage = ({ data }) => handleRemote(JSON.parse(data))
+      ws.onclose = (e) => {
+        if (wsRef.current === ws) wsRef.current = undefined
+        // 1008: no longer allowed on this canvas
+        if (stopped || e.code === 1008) return
+        // 1013: we fell behind, or sent edits faster than the server takes them
+        // and some never arrived; a position it can't resume from gets us the
+        // whole board as it stands
+        if (e.code === 1013) resumeRef.current = { epoch: "", seq: 0 }
+        // the server replays whatever we miss while away, so just back off and retry
+        const delay = Math.min(10000, 500 * 2 ** attempts) * (0.5 + Math.random() / 2)
+        attempts += 1
+        retry = setTimeout(open, delay)
+      }
+    }
+    // the socket carries on from where the fetched copy left off; without a
+    // position the server sends the whole board instead
     apiCall(`/api/canvases/${id}/data`)
       .then((r) => r.json())
-      .then(({ content }) => {
-        setObjects(content.objects || [])
-        setStrokes(content.strokes || [])
-        if (content.image && canvasRef.current) {
-          const ctx = canvasRef.current.getContext("2d")!
-          const img = new Image()
-          img.onload = () => {
-            ctx.clearRect(0, 0, 800, 600)
-            ctx.drawImage(img, 0, 0)
-            replayStrokes(ctx, content.strokes || [])
-          }
-          img.src = content.image
+      .then(({ content, session }) => {
+        if (stopped) return
+        applyContent(content)
+        if (session) {
+          const [epoch, seq] = session.split(":")
+          resumeRef.current = { epoch, seq: Number(seq) }
         }
       })
       .catch(console.error)
+      .finally(() => {
+        if (!stopped) open()
+      })
     setIsDirty(false)
-  }, [id, token])
-
-  useEffect(() => {
-    if (!token || !id) return
-    const ws = new WebSocket(
-      `ws://localhost:8000/ws/canvas/${id}?token=${token}`
-    )
-    wsRef.current = ws
-    ws.onmessage = ({ data }) => handleRemote(JSON.parse(data))
-    return () => ws.close()
+    return () => {
+      stopped = true
+      clearTimeout(retry)
+      ws?.close()
+    }
   }, [id, token])
 
   function handleRemote(msg: any) {
+    if (msg.type === "session") {
+      resumeRef.current = { epoch: msg.payload.epoch, seq: msg.payload.seq }
+      return
+    }
+    if (typeof msg.seq === "number" && resumeRef.current) {
+      resumeRef.current.seq = Math.max(resumeRef.current.seq, msg.seq)
+    }
+    if (msg.type === "presence") {
+      // the first one after (re)connecting is the whole room and names our own key
+      if (msg.self) presenceKeyRef.current = msg.self
+      setPeers(prev => {
+        const next = msg.self ? {} : { ...prev }
+        for (const [key, entry] of Object.entries<any>(msg.payload)) {
+          if (entry === null) delete next[key]
+          else next[key] = entry
+        }
+        return next
+      })
+      return
+    }
+    if (msg.type === "throttled") {
+      // the server dropped some of our cursor or draw messages (never edits);
+      // it says so at most once a second
+      console.warn(`Sending too fast (${msg.payload.scope} limit), retry in ${msg.payload.retryAfter}s`)
+      return
+    }
+    if (msg.type === "snapshot") {
+      // no position to carry on from, or we were away too long for a replay:
+      // the server sent the whole board instead
+      applyContent(msg.payload.content)
+      return
+    }
+    if (msg.type === "batch") {
+      msg.payload.forEach(handleRemote)
+      return
+    }
     const ctx = canvasRef.current?.getContext("2d")
     if (msg.type === "draw" && ctx) {
     const { x, y, color: c, size: s, mode: m } = msg.payload
@@ -258,9 +346,7 @@ const CanvasPage: React.FC = () => {
           const file = input.files?.[0]
           if (!file) return
           
-          const reader = new FileReader()
-          reader.onload = () => {
-            const dataUrl = reader.result as string
+          uploadMedia(file, token).then((url) => {
             const img = new Image()
             img.onload = () => {
               const imgWidth = img.width
@@ -283,7 +369,7 @@ const CanvasPage: React.FC = () => {
                 width,
                 height,
                 rotation: 0,
-                src: dataUrl, // Use base64 data URL instead of blob URL
+                src: url,
               }
               setObjects((objs) => [...objs, obj])
               wsRef.current?.send(
@@ -291,9 +377,8 @@ const CanvasPage: React.FC = () => {
               )
               setIsDirty(true)
             }
-            img.src = dataUrl
-          }
-          reader.readAsDataURL(file) // Convert to base64 data URL
+            img.src = url
+          }).catch(console.error)
         }
         input.click()
         return
@@ -307,10 +392,9 @@ const CanvasPage: React.FC = () => {
           const file = input.files?.[0]
           if (!file) return
           
-          // Convert file to base64 data URL for sharing across users
-          const reader = new FileReader()
-          reader.onload = () => {
-            const dataUrl = reader.result as string
+          // uploaded in chunks; the canvas only keeps the URL, and playback
+          // streams it with range requests
+          uploadMedia(file, token).then((url) => {
             const obj: CanvasObject = {
               id: crypto.randomUUID(),
               type: "audio",
@@ -318,7 +402,7 @@ const CanvasPage: React.FC = () => {
               y,
               width: 250,
               height: 80,
-              url: dataUrl, // Use base64 data URL instead of blob URL
+              url,
               filename: file.name,
             }
             setObjects((objs) => [...objs, obj])
@@ -326,8 +410,7 @@ const CanvasPage: React.FC = () => {
               JSON.stringify({ type: "objectAdd", payload: obj })
             )
             setIsDirty(true)
-          }
-          reader.readAsDataURL(file) // Convert to base64 data URL
+          }).catch(console.error)
         }
         input.click()
         return
@@ -453,6 +536,29 @@ const CanvasPage: React.FC = () => {
     }
   }, [mode, color, size, zoom])
 
+  useEffect(() => {
+    const canvas = canvasRef.current
+    if (!canvas) return
+    // the server only forwards the latest position every tick, so there's no
+    // point sending much faster than that
+    let last = 0
+    const onPointer = (e: MouseEvent) => {
+      const now = Date.now()
+      if (now - last < 50) return
+      last = now
+      const rect = canvas.getBoundingClientRect()
+      wsRef.current?.send(JSON.stringify({
+        type: "presence",
+        payload: {
+          x: ((e.clientX - rect.left) * 100) / zoom,
+          y: ((e.clientY - rect.top) * 100) / zoom,
+        },
+      }))
+    }
+    canvas.addEventListener("mousemove", onPointer)
+    return () => canvas.removeEventListener("mousemove", onPointer)
+  }, [zoom])
+
   useEffect(() => {
     const canvas = canvasRef.current;
     if (!canvas) return;
@@ -850,6 +956,22 @@ const CanvasPage: React.FC = () => {
                   onSelect={setSelectedId}
                 />
               ))}
+              {/* Other people's cursors */}
+              {Object.entries(peers).map(([key, peer]) =>
+                key === presenceKeyRef.current || !peer.state ? null : (
+                  <div
+                    key={key}
+                    className="absolute pointer-events-none flex items-center gap-1"
+                    style={{
+                      left: 400 + (peer.state.x - 400) * (zoom / 100),
+                      top: 300 + (peer.state.y - 300) * (zoom / 100),
+                    }}
+                  >
+                    <div className="w-2 h-2 rounded-full bg-blue-500" />
+                    <span className="text-xs bg-blue-500 text-white px-1 rounded">{peer.user}</span>
+                  </div>
+                )
+              )}
             </div>
           </main>
 
@@ -1,7 +1,7 @@
 import React, { useContext, useState, useEffect } from "react";
 import { useNavigate } from "react-router-dom";
 import { AuthContext } from "../context/AuthContext";
-import type { Canvas, Invitation } from "../../types";
+import type { Canvas } from "../../types";
 import {
   Card,
   CardHeader,
@@ -12,6 +12,37 @@ import { Button } from "../components/ui/button";
 import { List, ListItem } from "../components/ui/list";
 import { Separator } from "../components/ui/separator";
 
+// <img> can't send the bearer token, so fetch the thumbnail and show it from
+// an object URL; the browser cache still revalidates it by ETag
+const CanvasThumbnail: React.FC<{ id: number; token: string | null }> = ({ id, token }) => {
+  const [src, setSrc] = useState<string | null>(null);
+
+  useEffect(() => {
+    let url: string | null = null;
+    let cancelled = false;
+    fetch(`/api/canvases/${id}/thumbnail`, {
+      headers: { Authorization: `Bearer ${token}` },
+    })
+      .then((r) => (r.ok ? r.blob() : Promise.reject()))
+      .then((blob) => {
+        if (cancelled) return;
+        url = URL.createObjectURL(blob);
+        setSrc(url);
+      })
+      .catch(() => {});
+    return () => {
+      cancelled = true;
+      if (url) URL.revokeObjectURL(url);
+    };
+  }, [id, token]);
+
+  return src ? (
+    <img src={src} alt="" className="w-20 h-[60px] rounded border object-cover" />
+  ) : (
+    <div className="w-20 h-[60px] rounded border bg-gray-100" />
+  );
+};
+
 const Dashboard: React.FC = () => {
   const { token, setToken } = useContext(AuthContext);
   const [menuOpen, setMenuOpen] = useState(false);
@@ -29,39 +60,30 @@ const Dashboard: React.FC = () => {
   const [pwdError, setPwdError] = useState<string | null>(null);
   const [loadingPwd, setLoadingPwd] = useState(false);
 
-  const [myCanvases, setMyCanvases] = useState<Canvas[]>([]);
-  const [joined, setJoined] = useState<Canvas[]>([]);
+  const [boards, setBoards] = useState<(Canvas & { role: string })[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const navigate = useNavigate();
+  const myCanvases = boards.filter((c) => c.role === "owner");
+  const joined = boards.filter((c) => c.role !== "owner");
 
-  const loadMy = () =>
-    fetch("/api/canvases", {
+  // owned and shared canvases come back together, newest first, a page at a time
+  const loadPage = (cursor: string | null = null) => {
+    const params = new URLSearchParams({ fields: "id,name,role,updated_at" });
+    if (cursor) params.set("cursor", cursor);
+    return fetch(`/api/dashboard?${params}`, {
       headers: { Authorization: `Bearer ${token}` },
     })
       .then((r) => r.json())
-      .then(setMyCanvases)
-      .catch(console.error);
-
-  const loadJoined = () =>
-    fetch("/api/invitations", {
-      headers: { Authorization: `Bearer ${token}` },
-    })
-      .then((r) => r.json())
-      .then((invs: Invitation[]) =>
-        Promise.all(
-          invs.map((inv) =>
-            fetch(`/api/canvases/${inv.canvas_id}`, {
-              headers: { Authorization: `Bearer ${token}` },
-            }).then((r) => r.json())
-          )
-        )
-      )
-      .then(setJoined)
+      .then((page) => {
+        setBoards((prev) => (cursor ? [...prev, ...page.items] : page.items));
+        setNextCursor(page.next_cursor ?? null);
+      })
       .catch(console.error);
+  };
 
   useEffect(() => {
     if (!token) return;
-    loadMy();
-    loadJoined();
+    loadPage();
   }, [token]);
 
   const handleNew = () =>
@@ -94,7 +116,7 @@ const Dashboard: React.FC = () => {
       },
       body: JSON.stringify({ name: newName }),
     })
-      .then(() => loadMy())
+      .then(() => loadPage())
       .catch(console.error);
   };
 
@@ -104,7 +126,7 @@ const Dashboard: React.FC = () => {
       method: "DELETE",
       headers: { Authorization: `Bearer ${token}` },
     })
-      .then(() => loadMy())
+      .then(() => loadPage())
       .catch(console.error);
   };
 
@@ -232,12 +254,15 @@ const Dashboard: React.FC = () => {
                   key={c.id}
                   className="flex items-center justify-between"
                 >
-                  <Button
-                    variant="link"
-                    onClick={() => navigate(`/canvas/${c.id}`)}
-                  >
-                    {c.name}
-                  </Button>
+                  <div className="flex items-center space-x-2">
+                    <CanvasThumbnail id={c.id} token={token} />
+                    <Button
+                      variant="link"
+                      onClick={() => navigate(`/canvas/${c.id}`)}
+                    >
+                      {c.name}
+                    </Button>
+                  </div>
                   <div className="flex space-x-2">
                     <Button variant="outline" onClick={() => handleRename(c)}>
                       ✏️
@@ -263,7 +288,8 @@ const Dashboard: React.FC = () => {
           ) : (
             <List>
               {joined.map((c) => (
-                <ListItem key={c.id}>
+                <ListItem key={c.id} className="flex items-center space-x-2">
+                  <CanvasThumbnail id={c.id} token={token} />
                   <Button
                     variant="link"
                     onClick={() => navigate(`/canvas/${c.id}`)}
@@ -275,6 +301,12 @@ const Dashboard: React.FC = () => {
             </List>
           )}
         </div>
+
+        {nextCursor && (
+          <Button variant="outline" onClick={() => loadPage(nextCursor)}>
+            Load more
+          </Button>
+        )}
       </CardContent>
 
       {showChangeEmail && (